@@ -1,12 +1,16 @@
-import requests
 import os
+import sys
 import json
-import time
 import datetime as dt
 import pandas as pd
 from dotenv import load_dotenv
 from pathlib import Path
-from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_result
+
+sys.path.append(str(Path(__file__).parent.parent))
+from Shared.credentials import Account, AccountPool, env_credential_sets, retry_after_seconds
+from Shared.adapters import FxOpenAdapter
+from Shared.errors import (PERMANENT, CircuitBreaker, request_retry, request_error
+                           , classify_status, classify_exception, response_body)
 
 
 LABEL_MAP = {  'Open'   : 'o'
@@ -15,7 +19,20 @@ LABEL_MAP = {  'Open'   : 'o'
              , 'Close'  : 'c'
              }
 
-THROTTLE_TIME = 0.25
+PRICE_LABELS = {  'B' : 'bid'
+                , 'A' : 'ask'
+                }
+
+OHLC_COLUMNS = [ f'{label}_{ohlc}'
+                 for label in ['bid', 'ask', 'mid']
+                 for ohlc in LABEL_MAP.values()
+               ]
+
+CREDENTIAL_KEYS = ['FX_LOGIN', 'FX_API_ID', 'FX_API_KEY', 'FX_API_SECRET']
+
+THROTTLE_TIME = FxOpenAdapter.rate_limit    # min seconds between requests of the same account
+
+TICK_REQUEST_LIMIT = 1000
 
 
 def fxopen_timestamp_now():
@@ -24,14 +41,33 @@ def fxopen_timestamp_now():
     return curr_ts
 
 
+def price_components(price):
+    components = [c for c in PRICE_LABELS if c in price.upper()]
+    if len(components) == 0:
+        raise ValueError(f"price must contain 'B' and/or 'A', got {price!r}")
+    return components
+
+
+def complete_price_columns(df):
+    # mid is derived in bulk when both sides were fetched, sides that were
+    # not fetched are kept as NaN columns so the stored schema never changes
+    if all(f'{side}_o' in df.columns for side in ['bid', 'ask']):
+        for ohlc in LABEL_MAP.values():
+            df[f'mid_{ohlc}'] = (df[f'ask_{ohlc}'] + df[f'bid_{ohlc}']) / 2
+    return df.reindex(columns=['time', *OHLC_COLUMNS])
+
+
 class FxApi:
 
     def __init__(self):
         self.get_credentials()
-        self.make_auth_header()
-        self.session = requests.Session()
-        self.session.headers.update(self.AUTH_HEADER)
-        self.last_req_time = dt.datetime.now()
+        self.pool = AccountPool([Account(credentials['FX_LOGIN'] or f'account_{n}'
+                                         , credentials
+                                         , self.make_auth_header(credentials)
+                                         , THROTTLE_TIME
+                                         ) for n, credentials in enumerate(self.credential_sets)])
+        self.session = self.pool.accounts[0].session
+        self.breaker = CircuitBreaker()
 
 # /////////////////////////////////////////////////////////////////////////
 # /// AUTHENTICATION /////////////////////////////////////////////////////
@@ -39,11 +75,15 @@ class FxApi:
 
     def get_credentials(self):
         load_dotenv(Path(__file__).parent.parent / '.env')
+
+        # FX_LOGIN_2, FX_API_ID_2 ... add more accounts to the pool
+        self.credential_sets   = env_credential_sets(CREDENTIAL_KEYS)
+        primary                = self.credential_sets[0]
         
-        self.login_basic       = os.getenv(f'FX_LOGIN')
-        self.api_id_basic      = os.getenv(f'FX_API_ID')
-        self.api_key_basic     = os.getenv(f'FX_API_KEY')
-        self.api_secret_basic  = os.getenv(f'FX_API_SECRET')
+        self.login_basic       = primary['FX_LOGIN']
+        self.api_id_basic      = primary['FX_API_ID']
+        self.api_key_basic     = primary['FX_API_KEY']
+        self.api_secret_basic  = primary['FX_API_SECRET']
         
         self.fxopen_url        = os.getenv(f'FX_URL')
 
@@ -51,34 +91,23 @@ class FxApi:
 # /// BASIC AUTH /////////////////////////////////////////////////////////
 # ------------------------------------------------------------------------
     
-    def make_auth_header(self):
-        authorization = f'Basic {self.api_id_basic}:{self.api_key_basic}:{self.api_secret_basic}'
-        self.AUTH_HEADER = {  'Authorization':authorization
-                            , 'Content-Type' :'application/json'
-                            , 'Accept'       :'application/json'
-                            }
-    
-
-# /////////////////////////////////////////////////////////////////////////
-# /// THROTTLE HANDLER ///////////////////////////////////////////////////
-# ///////////////////////////////////////////////////////////////////////
-    
-    def throttle(self):
-        el_s = (dt.datetime.now() - self.last_req_time).total_seconds()
-        if el_s < THROTTLE_TIME:
-            time.sleep(THROTTLE_TIME - el_s)
-        self.last_req_time = dt.datetime.now()
+    def make_auth_header(self, credentials):
+        authorization = (f"Basic {credentials['FX_API_ID']}:{credentials['FX_API_KEY']}"
+                         f":{credentials['FX_API_SECRET']}")
+        return {  'Authorization':authorization
+                , 'Content-Type' :'application/json'
+                , 'Accept'       :'application/json'
+                }
 
 
 # /////////////////////////////////////////////////////////////////////////
 # /// REQUESTS ///////////////////////////////////////////////////////////
 # ///////////////////////////////////////////////////////////////////////
 
-    @retry(
-        wait=wait_exponential(multiplier=1, min=1, max=10),
-        stop=stop_after_attempt(5),
-        retry=retry_if_result(lambda result: result[0] is False)
-    )
+    # Transient errors are retried within RETRY_BUDGETS, permanent ones
+    # (bad symbol, 4xx, auth) return at once and count towards the circuit
+    # breaker of breaker_key, which rejects requests while it is open
+    @request_retry
     def make_request(self
                      , url_sufix
                      , verb='get'
@@ -86,57 +115,78 @@ class FxApi:
                      , params=None
                      , data=None
                      , headers=None
+                     , breaker_key=None
                      ):
 
-        self.throttle()
+        if breaker_key is not None and self.breaker.is_open(breaker_key):
+            return self.breaker.rejected()
+
         full_url = f"{self.fxopen_url}/{url_sufix}"
 
         if data is not None:
             data = json.dumps(data)
 
-        try:
-            response = None
-            if verb == "get":
-                response = self.session.get(full_url
-                                            , params=params
-                                            , data=data
-                                            , headers=headers)
-            if verb == "post":
-                response = self.session.post(full_url
-                                             , params=params
-                                             , data=data
-                                             , headers=headers)
-            if verb == "put":
-                response = self.session.put(full_url
-                                            , params=params
-                                            , data=data
-                                            , headers=headers)
-            if verb == "delete":
-                response = self.session.delete(full_url
-                                               , params=params
-                                               , data=data
-                                               , headers=headers)
-            
-            if response == None:
-                return False, {'error': 'verb not found'}
-
-            if response.status_code == success_code:
-                return True, response.json()
-            else:
-                return False, response.json()
-            
-        except Exception as error:
-            return False, {'Exception': error}
+        # The pool spaces requests of each account by THROTTLE_TIME and routes
+        # to the least loaded account that is not out of rotation
+        with self.pool.account() as (account, outcome):
+            try:
+                response = None
+                if verb == "get":
+                    response = account.session.get(full_url
+                                                   , params=params
+                                                   , data=data
+                                                   , headers=headers)
+                if verb == "post":
+                    response = account.session.post(full_url
+                                                    , params=params
+                                                    , data=data
+                                                    , headers=headers)
+                if verb == "put":
+                    response = account.session.put(full_url
+                                                   , params=params
+                                                   , data=data
+                                                   , headers=headers)
+                if verb == "delete":
+                    response = account.session.delete(full_url
+                                                      , params=params
+                                                      , data=data
+                                                      , headers=headers)
+                
+                if response == None:
+                    return False, request_error(PERMANENT, error='verb not found')
+
+                outcome['status_code'] = response.status_code
+                outcome['retry_after'] = retry_after_seconds(response)
+                if response.status_code == success_code:
+                    result = True, response.json()
+                else:
+                    result = False, request_error(classify_status(response.status_code)
+                                                  , response.status_code
+                                                  , response_body(response))
+                
+            except Exception as error:
+                result = False, request_error(classify_exception(error), Exception=error)
+
+        if breaker_key is not None:
+            self.breaker.record(breaker_key, result)
+        return result
         
 
 # /// CANDLES ////////////////////////////////////////////////////////////
 # ------------------------------------------------------------------------
 
+    def candles_key(self, symbol, granularity):
+        return f'{symbol}/{granularity}/bars'
+
+    def candles_blocked(self, symbol, granularity):
+        return self.breaker.is_open(self.candles_key(symbol, granularity))
+
     def fetch_candles(self
                       , symbol : str
                       , count = -10
                       , granularity = "M1"
                       , timestamp_from = None # In FxOpen format
+                      , price = 'BA'
                       ):
         url_symbol = symbol.replace('#', '%23')
         if timestamp_from is None:
@@ -151,22 +201,27 @@ class FxApi:
 
         base_url_sufix = f"quotehistory/{url_symbol}/{granularity}/bars/"
 
-        ok_bid, bid_data = self.make_request(base_url_sufix+"bid", params=params)
-        ok_ask, ask_data = self.make_request(base_url_sufix+"ask", params=params)
-
-        if ok_ask and ok_bid:
-            return True, [ask_data, bid_data]
-        print(
-            f'fetch_candles() failed. bid_ok: {ok_bid}, ask_ok: {ok_ask}. '
-            f'symbol {symbol}, count {count}, granularity {granularity}, '
-            f'timestamp_from {timestamp_from}')
-        return False, None
+        data = {}
+        for component in price_components(price):
+            label = PRICE_LABELS[component]
+            ok, data[label] = self.make_request(base_url_sufix+label
+                                                , params=params
+                                                , breaker_key=self.candles_key(symbol, granularity)
+                                                )
+            if ok == False:
+                print(
+                    f'fetch_candles() failed. {label}_ok: {ok}. '
+                    f'symbol {symbol}, count {count}, granularity {granularity}, '
+                    f'timestamp_from {timestamp_from}')
+                return False, None
+
+        return True, data
     
-    def make_bar_dict(self, price_label: str, item):
-        data = dict(time=pd.to_datetime(item['Timestamp'], unit='ms'))
-        for ohlc in LABEL_MAP.keys():
-            data[f"{price_label}_{LABEL_MAP[ohlc]}"]=item[ohlc]
-        return data
+    def make_bars_df(self, price_label: str, bars):
+        df = pd.DataFrame(bars, columns=['Timestamp', *LABEL_MAP.keys()])
+        df = df.rename(columns={k: f"{price_label}_{v}" for k, v in LABEL_MAP.items()})
+        df.insert(0, 'time', pd.to_datetime(df.pop('Timestamp'), unit='ms'))
+        return df
     
 
     def fetch_candles_as_df(self
@@ -174,6 +229,7 @@ class FxApi:
                             , count = -10
                             , granularity = "M1"
                             , date_start = None
+                            , price = 'BA'
                             ):
 
         if date_start is not None:
@@ -181,43 +237,38 @@ class FxApi:
         else:
             timestamp_from = fxopen_timestamp_now()
 
-        ok, data_list = self.fetch_candles(symbol, count, granularity, timestamp_from)
+        ok, data = self.fetch_candles(symbol, count, granularity, timestamp_from, price)
 
         if ok == False:
             print(f'fetch_candles_as_df() got no candles.')
             return None
-        
-        data_ask, data_bid = data_list
 
-        if (data_ask is None) or (data_bid is None):
-            print(f'fetch_candles_as_df() data_ask is None: {data_ask is None}, '
-                      f'data_bid is None: {data_bid is None}')
+        if any(side_data is None for side_data in data.values()):
+            print(f'fetch_candles_as_df() data is None: '
+                  f'{ {k: v is None for k, v in data.items()} }')
             return None
         
-        if ("Bars" in data_ask == False) or ("Bars" in data_bid == False):
-            print(f'fetch_candles_as_df() Bars in data_ask: {"Bars" in data_ask}, '
-                      f'Bars in data_bid: {"Bars" in data_bid}')
+        if any("Bars" not in side_data for side_data in data.values()):
+            print(f'fetch_candles_as_df() Bars in data: '
+                  f'{ {k: "Bars" in v for k, v in data.items()} }')
             return pd.DataFrame()
-        
-        ask_bars = data_ask["Bars"]
-        bid_bars = data_bid["Bars"]
 
-        if len(ask_bars) == 0 or len(bid_bars) == 0:
-            print(f'fetch_candles_as_df() len(ask_bars): {len(ask_bars)}, '
-                      f'len(bid_bars): {len(bid_bars)}')
+        if any(len(side_data["Bars"]) == 0 for side_data in data.values()):
+            print(f'fetch_candles_as_df() len(bars): '
+                  f'{ {k: len(v["Bars"]) for k, v in data.items()} }')
             return pd.DataFrame()
 
-        AvailableTo = pd.to_datetime(data_bid['AvailableTo'], unit='ms')
-
-        bids = [self.make_bar_dict('bid', item) for item in bid_bars]
-        asks = [self.make_bar_dict('ask', item) for item in ask_bars]
+        AvailableTo = pd.to_datetime(next(iter(data.values()))['AvailableTo'], unit='ms')
 
-        df_bid = pd.DataFrame.from_dict(bids)
-        df_ask = pd.DataFrame.from_dict(asks)
-        df_merged = pd.merge(left=df_bid, right=df_ask, on='time')    
+        df_merged = None
+        for label, side_data in data.items():
+            df_side = self.make_bars_df(label, side_data["Bars"])
+            if df_merged is None:
+                df_merged = df_side
+            else:
+                df_merged = pd.merge(left=df_merged, right=df_side, on='time')
 
-        for i in ['_o', '_h', '_l', '_c']:
-            df_merged[f'mid{i}'] = (df_merged[f'ask{i}'] + df_merged[f'bid{i}']) / 2
+        df_merged = complete_price_columns(df_merged)
 
         if df_merged.shape[0] > 0 and df_merged.iloc[-1].time == AvailableTo:
             df_merged = df_merged[:-1]  
@@ -225,6 +276,31 @@ class FxApi:
         return df_merged
         
 
+# /// TICKS //////////////////////////////////////////////////////////////
+# ------------------------------------------------------------------------
+
+    def fetch_ticks(self
+                    , symbol : str
+                    , timestamp_from # In FxOpen format
+                    , count = TICK_REQUEST_LIMIT
+                    ):
+        url_symbol = symbol.replace('#', '%23')
+        params = dict(timestamp=timestamp_from
+                      , count=count
+                      )
+        ok, data = self.make_request(f"quotehistory/{url_symbol}/ticks"
+                                     , params=params
+                                     , breaker_key=f'{symbol}/ticks'
+                                     )
+
+        if ok and data is not None and 'Ticks' in data:
+            return True, data['Ticks']
+        print(
+            f'fetch_ticks() failed. symbol {symbol}, count {count}, '
+            f'timestamp_from {timestamp_from}, data {data}')
+        return False, None
+
+
 # /// INTRUMENTS /////////////////////////////////////////////////////////
 # ------------------------------------------------------------------------
 
@@ -1,5 +1,5 @@
 from api import FxApi
-import pandas as pd
+from get_quotes import load_from_file
 import json
 from pathlib import Path
 import math
@@ -72,7 +72,7 @@ if __name__ == '__main__':
         has_candles[symbol] = {}
         for gran in granularity_lst:
             try:
-                df = pd.read_pickle(QUOTES/f'{symbol}_{gran}.pkl')
+                df = load_from_file(symbol, gran, QUOTES)
                 candles = len(df)
             except:
                 candles = 0
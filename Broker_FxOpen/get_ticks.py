@@ -0,0 +1,389 @@
+import numpy as np
+import pandas as pd
+import struct
+import json
+import time
+import os
+from dateutil import parser
+from api import FxApi, TICK_REQUEST_LIMIT
+from pathlib import Path
+
+
+TICKS_FOLDER = Path(__file__).parent / "hist_ticks"
+REFS_FOLDER  = Path(__file__).parent / "hist_quotes" / "refs"
+
+TICK_FLUSH_SIZE = 500_000   # ticks buffered in memory before appending to disk
+
+# Partition file: 32 byte header + fixed size records, one file per symbol and
+# month so a range read only maps the months it needs.
+#   header : magic, price bytes (4 or 8), price decimals
+#   record : int64 UTC epoch ms, scaled int bid, scaled int ask
+TICK_MAGIC  = b'PTTICKS1'
+HEADER      = struct.Struct('<8sBb22x')
+TICK_DTYPES = {  4 : np.dtype([('time', '<i8'), ('bid', '<i4'), ('ask', '<i4')])
+               , 8 : np.dtype([('time', '<i8'), ('bid', '<i8'), ('ask', '<i8')])
+               }
+
+BAR_MS = {  'S1' : 1000
+          , 'S5' : 5    * 1000
+          , 'S10': 10   * 1000
+          , 'S15': 15   * 1000
+          , 'S30': 30   * 1000
+          , 'M1' : 60   * 1000
+          , 'M5' : 5    * 60 * 1000
+          , 'M15': 15   * 60 * 1000
+          , 'M30': 30   * 60 * 1000
+          , 'H1' : 60   * 60 * 1000
+          , 'H4' : 240  * 60 * 1000
+          , 'D1' : 1440 * 60 * 1000
+          }
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// TICK STORAGE ///////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def partition_file(symbol, month, local_folder = TICKS_FOLDER):
+    return Path(local_folder) / symbol / f'{month}.ticks'
+
+
+def read_header(filename):
+    with open(filename, 'rb') as f:
+        magic, price_bytes, decimals = HEADER.unpack(f.read(HEADER.size))
+    if magic != TICK_MAGIC:
+        raise ValueError(f'{filename} is not a tick partition')
+    return price_bytes, decimals
+
+
+def needed_price_bytes(bid, ask):
+    # int32 prices unless the scaled price needs more than half its range
+    return 4 if max(bid.max(), ask.max()) < 2**30 and min(bid.min(), ask.min()) > -2**30 else 8
+
+
+def tick_records(times, bid, ask, price_bytes):
+    records = np.empty(len(times), dtype=TICK_DTYPES[price_bytes])
+    records['time'] = times
+    records['bid'] = bid
+    records['ask'] = ask
+    return records
+
+
+def write_partition(filename, records, decimals):
+    # Whole partition through a temporary file, readers keep their old mapping
+    price_bytes = records.dtype['bid'].itemsize
+    tmp_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_filename, 'wb') as f:
+        f.write(HEADER.pack(TICK_MAGIC, price_bytes, decimals))
+        f.write(records.tobytes())
+    os.replace(tmp_filename, filename)
+
+
+def append_partition(filename, times, bid, ask, decimals):
+    price_bytes = needed_price_bytes(bid, ask)
+    if not os.path.exists(filename):
+        os.makedirs(Path(filename).parent, exist_ok=True)
+        write_partition(filename, tick_records(times, bid, ask, price_bytes), decimals)
+        return
+
+    stored, file_decimals = map_partition(filename)
+    if file_decimals != decimals:
+        raise ValueError(f'{filename} stores {file_decimals} decimals, got {decimals}')
+    stored_bytes = stored.dtype['bid'].itemsize
+    older = len(stored) > 0 and times[0] < stored['time'][-1]
+    if price_bytes <= stored_bytes and not older:
+        with open(filename, 'ab') as f:
+            f.write(tick_records(times, bid, ask, stored_bytes).tobytes())
+        return
+
+    # Prices too wide for the partition or ticks older than the stored ones
+    # (a back-fill): the month is rewritten merged, widened to 8 bytes if needed
+    price_bytes = max(price_bytes, stored_bytes)
+    records = np.concatenate([stored.astype(TICK_DTYPES[price_bytes])
+                              , tick_records(times, bid, ask, price_bytes)])
+    del stored
+    records = records[np.argsort(records['time'], kind='stable')]
+    write_partition(filename, records, decimals)
+
+
+def append_ticks(symbol, times, bid, ask, decimals, local_folder = TICKS_FOLDER):
+    if len(times) == 0:
+        return
+    months = times.astype('datetime64[ms]').astype('datetime64[M]')
+    splits = np.flatnonzero(months[1:] != months[:-1]) + 1
+    for start, end in zip(np.r_[0, splits], np.r_[splits, len(times)]):
+        filename = partition_file(symbol, str(months[start]), local_folder)
+        append_partition(filename, times[start:end], bid[start:end], ask[start:end], decimals)
+
+
+def map_partition(filename):
+    price_bytes, decimals = read_header(filename)
+    if os.path.getsize(filename) == HEADER.size:
+        return np.empty(0, dtype=TICK_DTYPES[price_bytes]), decimals
+    records = np.memmap(filename, dtype=TICK_DTYPES[price_bytes], mode='r', offset=HEADER.size)
+    return records, decimals
+
+
+def list_partitions(symbol, date_start = None, date_end = None, local_folder = TICKS_FOLDER):
+    folder = Path(local_folder) / symbol
+    if not os.path.exists(folder):
+        return []
+    first = None if date_start is None else str(np.datetime64(parser.parse(date_start), 'M'))
+    last = None if date_end is None else str(np.datetime64(parser.parse(date_end), 'M'))
+    partitions = []
+    for filename in sorted(folder.glob('*.ticks')):
+        month = filename.stem
+        if (first is None or month >= first) and (last is None or month <= last):
+            partitions.append(filename)
+    return partitions
+
+
+def read_ticks(symbol, date_start = None, date_end = None, local_folder = TICKS_FOLDER):
+    frames = []
+    for filename in list_partitions(symbol, date_start, date_end, local_folder):
+        records, decimals = map_partition(filename)
+        records = slice_records(records, date_start, date_end)
+        frames.append(pd.DataFrame({  'time' : pd.to_datetime(records['time'], unit='ms')
+                                    , 'bid'  : records['bid'] / 10**decimals
+                                    , 'ask'  : records['ask'] / 10**decimals
+                                    }))
+    if len(frames) == 0:
+        return pd.DataFrame(columns=['time', 'bid', 'ask'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def slice_records(records, date_start = None, date_end = None):
+    start = 0 if date_start is None else np.searchsorted(records['time'], to_epoch_ms(date_start), 'left')
+    end = len(records) if date_end is None else np.searchsorted(records['time'], to_epoch_ms(date_end), 'right')
+    return records[start:end]
+
+
+def last_stored_ticks(symbol, local_folder = TICKS_FOLDER):
+    partitions = list_partitions(symbol, local_folder=local_folder)
+    for filename in reversed(partitions):
+        records, decimals = map_partition(filename)
+        if len(records) > 0:
+            return records, decimals
+    return None, None
+
+
+def first_stored_time(symbol, local_folder = TICKS_FOLDER):
+    for filename in list_partitions(symbol, local_folder=local_folder):
+        records, _ = map_partition(filename)
+        if len(records) > 0:
+            return int(records['time'][0])
+    return None
+
+
+def to_epoch_ms(date):
+    return int(pd.Timestamp(parser.parse(date) if isinstance(date, str) else date).timestamp() * 1000)
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// COLLECT TICKS //////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def symbol_precision(symbol, refs_folder = REFS_FOLDER):
+    refs_file = Path(refs_folder) / 'tradables_dict.json'
+    if not os.path.exists(refs_file):
+        raise ValueError(f'{refs_file} not found, run list_broker_inst.py first')
+    with open(refs_file, 'r') as f:
+        tradables_dict = json.load(f)
+    if symbol not in tradables_dict:
+        raise ValueError(f'{symbol} not in {refs_file}')
+    return int(tradables_dict[symbol]['Precision'])
+
+
+def side_price(side):
+    if side is None or side.get('Price') is None:
+        return np.nan
+    return side['Price']
+
+
+def ticks_to_arrays(ticks):
+    n = len(ticks)
+    times = np.fromiter((t['Timestamp'] for t in ticks), dtype='int64', count=n)
+    bid = np.fromiter((side_price(t.get('BestBid')) for t in ticks), dtype='float64', count=n)
+    ask = np.fromiter((side_price(t.get('BestAsk')) for t in ticks), dtype='float64', count=n)
+    return times, bid, ask
+
+
+def carry_forward(prices, last_price):
+    # A side missing from a tick keeps the last known quote, also across pages
+    prices = np.r_[last_price, prices]
+    valid = ~np.isnan(prices)
+    positions = np.maximum.accumulate(np.where(valid, np.arange(len(prices)), 0))
+    return prices[positions][1:]
+
+
+def collect_ticks(symbol
+                  , date_start
+                  , date_end
+                  , api: FxApi
+                  , precision = None
+                  , print_to_console = False
+                  , local_folder = TICKS_FOLDER
+                  ):
+    precision = symbol_precision(symbol) if precision is None else precision
+    end_ms = to_epoch_ms(date_end)
+    from_ms = to_epoch_ms(date_start)
+
+    # Only what lies outside the stored span is fetched: ticks older than the
+    # first stored one (back-fill, merged into their monthly partitions) and
+    # ticks after the last stored one (resume, skipping the ticks already
+    # stored for that same millisecond)
+    segments = [(from_ms, end_ms, 0, np.nan, np.nan)]
+    records, decimals = last_stored_ticks(symbol, local_folder)
+    if records is not None and records['time'][-1] >= from_ms:
+        first_ms, last_ms = first_stored_time(symbol, local_folder), int(records['time'][-1])
+        segments = []
+        if from_ms < first_ms:
+            segments.append((from_ms, min(end_ms, first_ms - 1), 0, np.nan, np.nan))
+        if end_ms > last_ms:
+            segments.append((last_ms, end_ms, int((records['time'] == last_ms).sum())
+                             , records['bid'][-1] / 10**decimals, records['ask'][-1] / 10**decimals))
+        if len(segments) == 0:
+            msg = (f"collect_ticks() {symbol} >> {pd.to_datetime(from_ms, unit='ms')} to {pd.to_datetime(end_ms, unit='ms')} "
+                   f"already stored ({pd.to_datetime(first_ms, unit='ms')} to {pd.to_datetime(last_ms, unit='ms')})")
+            print(msg) if print_to_console else print(msg)
+            return False
+
+    total = 0
+    for segment in segments:
+        total += fetch_tick_range(symbol, *segment, api, precision, print_to_console, local_folder)
+    msg = f"*** SAVED {symbol} ticks   >> total: {total} new ticks ***"
+    print(msg) if print_to_console else print(msg)
+    return total > 0
+
+
+def fetch_tick_range(symbol
+                     , from_ms
+                     , end_ms
+                     , skip
+                     , last_bid
+                     , last_ask
+                     , api: FxApi
+                     , precision
+                     , print_to_console = False
+                     , local_folder = TICKS_FOLDER
+                     ):
+    # Pages ticks from from_ms until end_ms (inclusive), flushing to disk as it goes
+    scale = 10**precision
+    buffer, buffered, total = [], 0, 0
+    while from_ms < end_ms:
+        ok, ticks = api.fetch_ticks(symbol, from_ms, TICK_REQUEST_LIMIT)
+        if not ok:
+            msg = f"collect_ticks() {symbol} >> from: {pd.to_datetime(from_ms, unit='ms')} --> REQUEST FAILED"
+            print(msg) if print_to_console else print(msg)
+            break
+        if len(ticks) == 0:
+            break
+
+        times, bid, ask = ticks_to_arrays(ticks)
+        new = ~((times == from_ms) & (np.cumsum(times == from_ms) <= skip))
+        new &= times <= end_ms
+
+        bid = carry_forward(bid, last_bid)
+        ask = carry_forward(ask, last_ask)
+        last_bid, last_ask = bid[-1], ask[-1]
+        new &= ~(np.isnan(bid) | np.isnan(ask))
+
+        if new.any():
+            buffer.append((times[new], np.rint(bid[new] * scale).astype('int64')
+                           , np.rint(ask[new] * scale).astype('int64')))
+            buffered += int(new.sum())
+
+        if times[-1] == from_ms:
+            # A full page inside one millisecond cannot be paged further
+            from_ms, skip = from_ms + 1, 0
+        else:
+            from_ms, skip = int(times[-1]), int((times == times[-1]).sum())
+
+        if buffered >= TICK_FLUSH_SIZE:
+            total += flush_ticks(symbol, buffer, precision, local_folder)
+            buffer, buffered = [], 0
+            msg = f"{symbol} ticks   >> stored {total} ticks until {pd.to_datetime(from_ms, unit='ms')}"
+            print(msg) if print_to_console else print(msg)
+
+        if len(ticks) < TICK_REQUEST_LIMIT:
+            break
+
+    total += flush_ticks(symbol, buffer, precision, local_folder)
+    return total
+
+
+def flush_ticks(symbol, buffer, precision, local_folder = TICKS_FOLDER):
+    if len(buffer) == 0:
+        return 0
+    times, bid, ask = (np.concatenate(parts) for parts in zip(*buffer))
+    append_ticks(symbol, times, bid, ask, precision, local_folder)
+    return len(times)
+
+
+def get_hist_ticks(symbol_lst
+                   , date_start
+                   , date_end
+                   , api
+                   ):
+    for symbol in symbol_lst:
+        start_time = time.time()
+        print(f'Fetching ticks for {symbol}')
+        ok = collect_ticks(symbol, date_start, date_end, api, print_to_console=True)
+        if ok:
+            min_to_complete = (time.time() - start_time)/60
+            print(f'Ticks saved for {symbol}, took {min_to_complete:.0f} minutes.')
+        else:
+            print(f'No new ticks for {symbol}')
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// BAR AGGREGATION ////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def bar_size_ms(bar):
+    if isinstance(bar, (int, float)):
+        return int(bar * 1000)
+    if bar in BAR_MS:
+        return BAR_MS[bar]
+    return int(pd.Timedelta(bar).total_seconds() * 1000)
+
+
+def aggregate_ticks(records, decimals, bar = 'M1'):
+    size = bar_size_ms(bar)
+    columns = ['time'] + [f'{side}_{x}' for side in ['bid', 'ask', 'mid'] for x in 'ohlc'] + ['ticks']
+    if len(records) == 0:
+        return pd.DataFrame(columns=columns)
+
+    bucket = records['time'] // size
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    ends = np.r_[starts[1:], len(bucket)] - 1
+    scale = 10**decimals
+
+    data = {'time': pd.to_datetime(bucket[starts] * size, unit='ms')}
+    for side in ['bid', 'ask']:
+        prices = np.asarray(records[side])
+        data[f'{side}_o'] = prices[starts] / scale
+        data[f'{side}_h'] = np.maximum.reduceat(prices, starts) / scale
+        data[f'{side}_l'] = np.minimum.reduceat(prices, starts) / scale
+        data[f'{side}_c'] = prices[ends] / scale
+    for x in 'ohlc':
+        data[f'mid_{x}'] = (data[f'ask_{x}'] + data[f'bid_{x}']) / 2
+    data['ticks'] = ends - starts + 1
+    return pd.DataFrame(data, columns=columns)
+
+
+def build_bars(symbol
+               , bar = 'M1'
+               , date_start = None
+               , date_end = None
+               , local_folder = TICKS_FOLDER
+               ):
+    # Partitions are month aligned, so any bar that divides a day never spans two
+    frames = []
+    for filename in list_partitions(symbol, date_start, date_end, local_folder):
+        records, decimals = map_partition(filename)
+        records = slice_records(records, date_start, date_end)
+        frames.append(aggregate_ticks(records, decimals, bar))
+    frames = [f for f in frames if not f.empty]
+    if len(frames) == 0:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,15 @@
+from get_ticks import get_hist_ticks, build_bars
+from api import FxApi
+
+
+if __name__ == '__main__':
+    fx_api = FxApi()
+
+    symbol_lst      = ['EURUSD']
+    date_start      = '2025-03-25T00:00:00'
+    date_end        = '2025-03-26T00:00:00'
+
+    get_hist_ticks(symbol_lst, date_start, date_end, fx_api)
+
+    for symbol in symbol_lst:
+        print(build_bars(symbol, 'S10', date_start, date_end))
@@ -1,22 +1,42 @@
-import requests
 import os
+import sys
 import pandas as pd
 from dateutil import parser
 from datetime import datetime as dt
 from dotenv import load_dotenv
 from pathlib import Path
-from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_result
 
+sys.path.append(str(Path(__file__).parent.parent))
+from Shared.credentials import Account, AccountPool, env_credential_sets, retry_after_seconds
+from Shared.adapters import OandaAdapter
+from Shared.errors import (PERMANENT, CircuitBreaker, request_retry, request_error
+                           , classify_status, classify_exception, response_body)
+
+
+OHLC = ['o', 'h', 'l', 'c']
+
+CREDENTIAL_KEYS = ['OANDA_API_KEY', 'OANDA_ACCOUNT_ID']
+
+THROTTLE_TIME = OandaAdapter.rate_limit     # min seconds between requests of the same account
+
+CANDLE_COLUMNS = ['time', 'volume'] + [ f'{price}_{item}'
+                                        for price in ['mid', 'bid', 'ask']
+                                        for item in OHLC
+                                      ]
 
 class OandaApi:
 
     def __init__(self):
-        self.session = requests.Session()
         self.get_credentials()
-        self.session.headers.update({
-            'Authorization': f'Bearer {self.api_key}',
-            'Content-Type': 'application/json'
-            })
+        self.pool = AccountPool([Account(credentials['OANDA_ACCOUNT_ID'] or f'account_{n}'
+                                         , credentials
+                                         , { 'Authorization': f"Bearer {credentials['OANDA_API_KEY']}"
+                                           , 'Content-Type': 'application/json'
+                                           }
+                                         , THROTTLE_TIME
+                                         ) for n, credentials in enumerate(self.credential_sets)])
+        self.session = self.pool.accounts[0].session
+        self.breaker = CircuitBreaker()
     
 
 
@@ -27,9 +47,13 @@ class OandaApi:
 
     def get_credentials(self):
         load_dotenv(Path(__file__).parent.parent / '.env')
+
+        # OANDA_API_KEY_2, OANDA_ACCOUNT_ID_2 ... add more accounts to the pool
+        self.credential_sets = env_credential_sets(CREDENTIAL_KEYS)
+        primary = self.credential_sets[0]
         
-        self.api_key    = os.getenv(f'OANDA_API_KEY')
-        self.account_id = os.getenv(f'OANDA_ACCOUNT_ID')
+        self.api_key    = primary['OANDA_API_KEY']
+        self.account_id = primary['OANDA_ACCOUNT_ID']
         self.oanda_url  = os.getenv(f'OANDA_URL')
 
 
@@ -39,30 +63,40 @@ class OandaApi:
 # ///////////////////////////////////////////////////////////////////////
 
 
-    @retry(
-        wait=wait_exponential(multiplier=1, min=1, max=10),
-        stop=stop_after_attempt(5),
-        retry=retry_if_result(lambda result: result[0] is False)
-    )
-    def make_request(self, url, requestType='get', succes_code=200, params=None, data=None, headers=None):
-        full_url = f'{self.oanda_url}/{url}'
-        try:
-            response = None
-            
-            if requestType == 'get':
-                response = self.session.get(full_url, params=params, data=data, headers=headers)
-            
-            if response == None:
-                return False, {'error': 'action returned empty'}
-            
-            if response.status_code == succes_code:
-                return True, response.json()
-            else:
-                return False, response.json()
-
+    # Transient errors are retried within RETRY_BUDGETS, permanent ones
+    # return at once and count towards the circuit breaker of breaker_key
+    @request_retry
+    def make_request(self, url, requestType='get', succes_code=200, params=None, data=None, headers=None, breaker_key=None):
+        if breaker_key is not None and self.breaker.is_open(breaker_key):
+            return self.breaker.rejected()
 
-        except Exception as error:
-            return False, {'Exception': error}
+        full_url = f'{self.oanda_url}/{url}'
+        with self.pool.account() as (account, outcome):
+            try:
+                response = None
+                
+                if requestType == 'get':
+                    response = account.session.get(full_url, params=params, data=data, headers=headers)
+                
+                if response == None:
+                    return False, request_error(PERMANENT, error='action returned empty')
+                
+                outcome['status_code'] = response.status_code
+                outcome['retry_after'] = retry_after_seconds(response)
+                if response.status_code == succes_code:
+                    result = True, response.json()
+                else:
+                    result = False, request_error(classify_status(response.status_code)
+                                                  , response.status_code
+                                                  , response_body(response))
+
+
+            except Exception as error:
+                result = False, request_error(classify_exception(error), Exception=error)
+
+        if breaker_key is not None:
+            self.breaker.record(breaker_key, result)
+        return result
 
 
     def get_account_endpoint(self, endpoint, data_key):
@@ -88,13 +122,19 @@ class OandaApi:
 # /// CANDLES ////////////////////////////////////////////////////////////
 # ------------------------------------------------------------------------
 
+    def candles_key(self, symbol, granularity):
+        return f'{symbol}/{granularity}/candles'
+
+    def candles_blocked(self, symbol, granularity):
+        return self.breaker.is_open(self.candles_key(symbol, granularity))
+
 
     def fetch_candles(
             self, 
             symbol, 
             count=10, 
             granularity='H1', 
-            price='MBA', 
+            price='BA', 
             date_f=None, 
             date_t=None
             ):
@@ -111,7 +151,7 @@ class OandaApi:
         else:
             params['count'] = count
         
-        requestWorked, data = self.make_request(url, params=params)
+        requestWorked, data = self.make_request(url, params=params, breaker_key=self.candles_key(symbol, granularity))
 
         if requestWorked == True and 'candles' in data:
             return data['candles']
@@ -130,7 +170,6 @@ class OandaApi:
             return pd.DataFrame() #make empty dataframe
 
         prices = ['mid', 'bid', 'ask']
-        ohlc = ['o', 'h', 'l', 'c']
         
         final_data = []
         for candle in data:
@@ -142,9 +181,24 @@ class OandaApi:
 
             for price in prices:
                 if price in candle:
-                    for item in ohlc:
+                    for item in OHLC:
                         new_dict[f'{price}_{item}'] = float(candle[price][item])
 
             final_data.append(new_dict)
         df = pd.DataFrame.from_dict(final_data)
-        return df
\ No newline at end of file
+        return complete_price_columns(df)
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// AUX FUNCTIONS //////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def complete_price_columns(df):
+    # mid is derived in bulk when only bid and ask were fetched, sides that
+    # were not fetched are kept as NaN columns so the stored schema never changes
+    if df.empty:
+        return df
+    if 'mid_o' not in df.columns and 'bid_o' in df.columns and 'ask_o' in df.columns:
+        for item in OHLC:
+            df[f'mid_{item}'] = (df[f'ask_{item}'] + df[f'bid_{item}']) / 2
+    return df.reindex(columns=CANDLE_COLUMNS)
@@ -0,0 +1,106 @@
+from pathlib import Path
+
+
+ROOT = Path(__file__).parent.parent
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// ADAPTER PROTOCOL ///////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+class BrokerAdapter:
+    # Declared limits and capabilities, read by Shared.engine to pick a fetch
+    # strategy and by Shared.planner to estimate a backfill
+    name = None
+    local_folder = None
+    max_candles = None          # candles per request
+    paging = None               # 'cursor': from + count, the next page starts after the
+                                #           last bar returned (skips market closures)
+                                # 'range' : independent from/to windows
+    price_sides = ''            # sides that can be requested, in request order
+    combined_sides = False      # all requested sides come back in one request
+    rate_limit = 0.0            # min seconds between requests of one account
+    concurrency = 1             # requests one account tolerates in flight
+    granularities = []
+
+    def __init__(self, api):
+        self.api = api
+
+    def accounts(self):
+        return len(self.api.pool)
+
+    def price_components(self, price):
+        components = [c for c in self.price_sides if c in price.upper()]
+        unsupported = set(price.upper()) - set(self.price_sides)
+        if len(components) == 0 or unsupported:
+            raise ValueError(f'{self.name} price must be made of {self.price_sides!r}, got {price!r}')
+        return components
+
+    @classmethod
+    def requests_per_window(cls, price):
+        return 1 if cls.combined_sides else len([c for c in cls.price_sides if c in price.upper()])
+
+    def blocked(self, symbol, granularity):
+        return self.api.candles_blocked(symbol, granularity)
+
+    def fetch(self, symbol, granularity, date_from, date_to, price):
+        # Candles from date_from as a DataFrame with naive UTC times, None when
+        # nothing came back. date_to is only honoured by 'range' paging.
+        raise NotImplementedError
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// BROKERS ////////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+class FxOpenAdapter(BrokerAdapter):
+    name = 'FxOpen'
+    local_folder = ROOT / 'Broker_FxOpen' / 'hist_quotes'
+    max_candles = 900
+    paging = 'cursor'
+    price_sides = 'BA'
+    combined_sides = False      # one request per side, mid is derived locally
+    rate_limit = 0.25
+    concurrency = 1
+    granularities = ['M1', 'M5', 'M15', 'M30', 'H1', 'H4', 'D1']
+
+    def fetch(self, symbol, granularity, date_from, date_to, price):
+        df = self.api.fetch_candles_as_df(symbol
+                                          , granularity = granularity
+                                          , count = self.max_candles
+                                          , date_start = date_from
+                                          , price = price
+                                          )
+        if df is None or df.empty:
+            return None
+        return df
+
+
+class OandaAdapter(BrokerAdapter):
+    name = 'Oanda'
+    local_folder = ROOT / 'Broker_Oanda' / 'hist_quotes'
+    max_candles = 3000
+    paging = 'range'
+    price_sides = 'MBA'
+    combined_sides = True
+    rate_limit = 0.0
+    concurrency = 4
+    granularities = ['M1', 'M5', 'M15', 'M30', 'H1', 'H2', 'H4', 'D']
+
+    def fetch(self, symbol, granularity, date_from, date_to, price):
+        df = self.api.get_candles_df(symbol = symbol
+                                     , granularity = granularity
+                                     , date_f = date_from
+                                     , date_t = date_to
+                                     , price = price
+                                     )
+        if df is None or df.empty:
+            return None
+        if getattr(df['time'].dt, 'tz', None) is not None:
+            df['time'] = df['time'].dt.tz_convert(None)
+        return df
+
+
+ADAPTERS = {  'FxOpen' : FxOpenAdapter
+            , 'Oanda'  : OandaAdapter
+            }
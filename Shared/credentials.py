@@ -0,0 +1,121 @@
+import os
+import time
+import threading
+import requests
+from contextlib import contextmanager
+
+
+MAX_ACCOUNTS   = 32
+AUTH_COOLDOWN  = 60 * 60    # seconds an account sits out after an auth error
+RATE_COOLDOWN  = 30         # seconds an account sits out after a rate limit error
+
+AUTH_STATUS = [401, 403]
+RATE_STATUS = [429]
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// CREDENTIAL SETS ////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def env_credential_sets(keys, max_accounts = MAX_ACCOUNTS):
+    # FX_API_ID, FX_API_ID_2, FX_API_ID_3 ... one set per suffix, stops at the
+    # first suffix whose first key is missing
+    credential_sets = []
+    for n in range(1, max_accounts + 1):
+        suffix = '' if n == 1 else f'_{n}'
+        if not os.getenv(f'{keys[0]}{suffix}'):
+            if n == 1:
+                continue
+            break
+        credential_sets.append({k: os.getenv(f'{k}{suffix}') for k in keys})
+    if len(credential_sets) == 0:
+        credential_sets.append({k: os.getenv(k) for k in keys})
+    return credential_sets
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// ACCOUNT POOL ///////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+class Account:
+
+    def __init__(self, name, credentials, headers, min_interval):
+        self.name = name
+        self.credentials = credentials
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.min_interval = min_interval
+        self.next_free = 0.0
+        self.in_flight = 0
+        self.disabled_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+
+class AccountPool:
+
+    def __init__(self, accounts):
+        self.accounts = accounts
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                active = [a for a in self.accounts if a.disabled_until <= now]
+                if active:
+                    account = min(active, key=lambda a: (a.in_flight, a.next_free))
+                    start = max(now, account.next_free)
+                    account.next_free = start + account.min_interval
+                    account.in_flight += 1
+                    account.requests += 1
+                    break
+                wait = min(a.disabled_until for a in self.accounts) - now
+            print(f'AccountPool all accounts out of rotation, waiting {wait:.0f}s')
+            time.sleep(max(wait, 0.1))
+
+        if start > now:
+            time.sleep(start - now)
+        return account
+
+    def release(self, account, status_code = None, retry_after = None):
+        with self.lock:
+            account.in_flight -= 1
+            if status_code in AUTH_STATUS:
+                account.errors += 1
+                account.disabled_until = time.monotonic() + AUTH_COOLDOWN
+                print(f'AccountPool {account.name} auth error {status_code} --> out of rotation')
+            elif status_code in RATE_STATUS:
+                account.errors += 1
+                account.disabled_until = time.monotonic() + (retry_after or RATE_COOLDOWN)
+                print(f'AccountPool {account.name} rate limited --> paused {retry_after or RATE_COOLDOWN}s')
+
+    @contextmanager
+    def account(self):
+        account = self.acquire()
+        outcome = {}
+        try:
+            yield account, outcome
+        finally:
+            self.release(account, outcome.get('status_code'), outcome.get('retry_after'))
+
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            return [dict(name=a.name
+                         , requests=a.requests
+                         , errors=a.errors
+                         , in_flight=a.in_flight
+                         , active=a.disabled_until <= now
+                         ) for a in self.accounts]
+
+
+def retry_after_seconds(response):
+    value = response.headers.get('Retry-After')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
@@ -0,0 +1,374 @@
+import os
+import time
+import datetime as dt
+import pandas as pd
+from pathlib import Path
+from dateutil import parser
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from Shared.adapters import BrokerAdapter
+from Shared.validation import (validate_candles, write_report, quarantine_folder, remember_validation
+                               , GRANULARITY_SECONDS, QUARANTINE_FOLDER)
+from Shared.storage import write_series, read_series, codec_for
+from Shared.timeutils import as_epoch_ms, as_datetime
+from Shared.index import update_index, fresh_entry
+from Shared.revisions import record_digests
+from Shared.locks import series_lock, LockBusy
+from Shared.memory import governor, estimate_job_bytes, ChunkBuffer
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// FETCH STRATEGY /////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def fetch_strategy(adapter: BrokerAdapter):
+    # 'range' paging has independent windows, so one series is fetched with
+    # several windows in flight. 'cursor' paging has to follow the cursor, so
+    # the parallelism goes into running more series side by side instead.
+    accounts = adapter.accounts()
+    if adapter.paging == 'range':
+        return dict(mode='windows', job_workers=accounts, window_workers=max(adapter.concurrency, 1))
+    return dict(mode='cursor', job_workers=max(accounts * adapter.concurrency, 1), window_workers=1)
+
+
+def last_allowed_date():
+    yesterday = dt.date.today() - dt.timedelta(days=1)
+    return dt.datetime(yesterday.year, yesterday.month, yesterday.day)
+
+
+def job_bytes(granularity, date_start, date_end):
+    # Memory reserved for a job, nothing is fetched past the last allowed date
+    date_end = min(parser.parse(str(date_end)).replace(tzinfo=None), last_allowed_date())
+    return estimate_job_bytes(granularity, parser.parse(str(date_start)).replace(tzinfo=None), date_end)
+
+
+def window_step(adapter, granularity):
+    return dt.timedelta(seconds=GRANULARITY_SECONDS[granularity] * adapter.max_candles)
+
+
+def log(msg, print_to_console):
+    print(msg) if print_to_console else print(msg)
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// COLLECT CANDLES ////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def log_window(adapter, symbol, granularity, from_date, candles_df, print_to_console):
+    msg = f"{symbol} {granularity}   >> "\
+          f"fetching {adapter.max_candles} candles since: {from_date}   >> "\
+          f"got {candles_df.time.min()}  until  {candles_df.time.max()}   >> "\
+          f"total: {candles_df.shape[0]} candles"
+    log(msg, print_to_console)
+
+
+def collect_cursor(adapter, symbol, granularity, date_start, date_end, price, print_to_console, buffer):
+    step = window_step(adapter, granularity)
+    lad = last_allowed_date()
+
+    from_date = date_start
+    while (from_date < date_end) and (from_date < lad):
+        to_date = min(from_date + step, lad)
+
+        if adapter.blocked(symbol, granularity):
+            log(f"collect_candles() {symbol} {granularity} keeps failing permanently --> skipping remaining windows"
+                , print_to_console)
+            break
+
+        candles_df = adapter.fetch(symbol, granularity, from_date, to_date, price)
+        if candles_df is not None:
+            log_window(adapter, symbol, granularity, from_date, candles_df, print_to_console)
+            from_date = max(candles_df.time.max(), to_date)
+            buffer.append(candles_df)
+        else:
+            from_date = to_date
+            log(f"collect_candles() {symbol} {granularity} >> from: {from_date} to: {to_date} --> NO CANDLES"
+                , print_to_console)
+
+
+def collect_windows(adapter, symbol, granularity, date_start, date_end, price, print_to_console, window_workers
+                    , buffer):
+    step = window_step(adapter, granularity)
+    end = min(date_end, last_allowed_date())
+    windows = []
+    from_date = date_start
+    while from_date < end:
+        windows.append((from_date, min(from_date + step, end)))
+        from_date = windows[-1][1]
+
+    def fetch_window(window):
+        from_date, to_date = window
+        if adapter.blocked(symbol, granularity):
+            return None
+        candles_df = adapter.fetch(symbol, granularity, from_date, to_date, price)
+        if candles_df is not None:
+            log_window(adapter, symbol, granularity, from_date, candles_df, print_to_console)
+        else:
+            log(f"collect_candles() {symbol} {granularity} >> from: {from_date} to: {to_date} --> NO CANDLES"
+                , print_to_console)
+        return candles_df
+
+    # At most window_workers windows in flight. Each frame goes into the buffer
+    # as soon as its window completes, so the governor counts it and it can
+    # spill, and the buffer puts the windows back in order on concat.
+    queued = enumerate(windows)
+    with ThreadPoolExecutor(max_workers=window_workers) as executor:
+        in_flight = {executor.submit(fetch_window, window): n for n, window in islice(queued, window_workers)}
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                n = in_flight.pop(future)
+                candles_df = future.result()
+                if candles_df is not None:
+                    buffer.append(candles_df, order=n)
+                for m, window in islice(queued, 1):
+                    in_flight[executor.submit(fetch_window, window)] = m
+    if adapter.blocked(symbol, granularity):
+        log(f"collect_candles() {symbol} {granularity} keeps failing permanently --> skipped remaining windows"
+            , print_to_console)
+
+
+def collect_candles(adapter: BrokerAdapter
+                    , symbol
+                    , granularity
+                    , date_start
+                    , date_end
+                    , print_to_console = False
+                    , price = 'BA'
+                    ):
+    components = adapter.price_components(price)
+    price = ''.join(components)
+    date_start = parser.parse(date_start).replace(tzinfo=None)
+    date_end = parser.parse(date_end).replace(tzinfo=None)
+
+    # Admitted by the memory governor before the download starts, chunks are
+    # spilled to disk if the job outgrows its reservation
+    job = f'{adapter.name}/{symbol}_{granularity}'
+    memory = governor()
+    strategy = fetch_strategy(adapter)
+    with memory.reservation(job, job_bytes(granularity, date_start, date_end)):
+        buffer = ChunkBuffer(job, adapter.local_folder, memory)
+        try:
+            if strategy['mode'] == 'windows':
+                collect_windows(adapter, symbol, granularity, date_start, date_end, price
+                                , print_to_console, strategy['window_workers'], buffer)
+            else:
+                collect_cursor(adapter, symbol, granularity, date_start, date_end, price
+                               , print_to_console, buffer)
+
+            if len(buffer) > 0:
+                complete_df = buffer.concat()
+                complete_df = drop_extra_candles(complete_df, date_start, date_end)
+                complete_df = drop_sort_df(complete_df)
+                complete_df.attrs['price_components'] = price
+                return True, complete_df
+        finally:
+            buffer.close()
+
+    log(f'collect_candles() {symbol} {granularity} --> NO DATA RETURNED!', print_to_console)
+    return False, None
+
+
+def collect_and_save_candles(adapter: BrokerAdapter
+                             , symbol
+                             , granularity
+                             , date_start
+                             , date_end
+                             , print_to_console = False
+                             , price = 'BA'
+                             , validate = True
+                             , replace_sides = False
+                             ):
+    # One writer per series across processes, an overlapping job for the same
+    # series is skipped instead of downloading it twice and racing the save
+    vault_folder = adapter.local_folder
+    filename = f"{vault_folder}/{symbol}_{granularity}.pkl"
+    try:
+        with series_lock(filename, blocking=False):
+            # Checked before downloading, save_to_file checks again
+            stored = stored_components(filename, vault_folder)
+            dropped = dropped_components(stored, ''.join(adapter.price_components(price)))
+            if dropped and not replace_sides:
+                log(f"collect_and_save_candles() {symbol} {granularity} is stored with {stored}, price {price!r} "
+                    f"would drop {dropped} --> SKIPPED, pass replace_sides=True to replace it", print_to_console)
+                return False
+            # The reservation covers validation and save as well, the frame is
+            # held until it is written
+            job = f'{adapter.name}/{symbol}_{granularity}'
+            with governor().reservation(job, job_bytes(granularity, date_start, date_end)) as usage:
+                ok = collect_validate_save(adapter, symbol, granularity, date_start, date_end
+                                           , print_to_console, price, validate, replace_sides)
+            log(f"collect_and_save_candles() {symbol} {granularity} memory >> "
+                f"reserved {usage['reserved'] / 1024**2:,.0f} MB, peak buffered {usage['peak'] / 1024**2:,.0f} MB, "
+                f"spilled {usage['spilled'] / 1024**2:,.0f} MB, waited {usage['waited']:.0f}s", print_to_console)
+            return ok
+    except LockBusy:
+        log(f'collect_and_save_candles() {symbol} {granularity} is being updated by another job --> SKIPPED'
+            , print_to_console)
+        return False
+
+
+def collect_validate_save(adapter, symbol, granularity, date_start, date_end, print_to_console, price, validate
+                          , replace_sides = False):
+    vault_folder = adapter.local_folder
+    ok, complete_df = collect_candles(adapter
+                                      , symbol
+                                      , granularity
+                                      , date_start
+                                      , date_end
+                                      , print_to_console
+                                      , price
+                                      )
+    if ok:
+        passed = True
+        local_folder = vault_folder
+        if validate:
+            report = validate_candles(complete_df, granularity)
+            write_report(report, f'{symbol}_{granularity}', vault_folder)
+            passed = report['passed']
+            if not passed:
+                local_folder = quarantine_folder(vault_folder)
+                failed = {k: v['count'] for k, v in report['checks'].items() if v['count'] > 0}
+                log(f'collect_and_save_candles() {symbol} {granularity} failed validation {failed} --> QUARANTINED'
+                    , print_to_console)
+
+        log('collect_candles() saving candles locally.', print_to_console)
+        saved = save_to_file(complete_df
+                             , adapter.name
+                             , granularity
+                             , symbol
+                             , print_to_console
+                             , local_folder
+                             , replace_sides
+                             )
+        if saved and validate and passed:
+            remember_validation(f"{vault_folder}/{symbol}_{granularity}.pkl", report, vault_folder)
+        if saved and passed:
+            return True
+    return False
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// STORE LOCALLY //////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def save_to_file(complete_df: pd.DataFrame
+                 , broker
+                 , granularity
+                 , symbol
+                 , print_to_console = False
+                 , local_folder = None
+                 , replace_sides = False
+                 ):
+    filename = f"{local_folder}/{symbol}_{granularity}.pkl"
+    quarantined = Path(local_folder).name == QUARANTINE_FOLDER
+    try:
+        # A download with fewer price sides than the stored series would
+        # replace the missing sides with NaN
+        if not quarantined and not replace_sides:
+            stored = stored_components(filename, local_folder)
+            dropped = dropped_components(stored, complete_df.attrs.get('price_components') or '')
+            if dropped:
+                raise ValueError(f'stored with {stored}, the new candles would drop {dropped}, '
+                                 f'pass replace_sides=True to replace them')
+        os.makedirs(local_folder, exist_ok=True)
+        stored_df = as_epoch_ms(complete_df)
+        write_series(stored_df, filename, *codec_for(broker, granularity))
+        # Quarantined series stay out of the index and digests, they are not
+        # part of the vault until a later download passes validation
+        if not quarantined:
+            update_index(stored_df, filename, local_folder)
+            record_digests(stored_df, filename, local_folder)
+
+        s1 = f"*** SAVED {symbol}_{granularity} hist quotes   >> "\
+            f"from: {complete_df.time.min()}   >> to: {complete_df.time.max()}"
+        log(f"{s1} --> total: {complete_df.shape[0]} candles ***", print_to_console)
+        return True
+    except Exception as error:
+        log(f'Failed to save {symbol}_{granularity} to {filename}  --  Error: {error}', print_to_console)
+        return False
+
+
+def load_from_file(symbol, granularity, local_folder):
+    return as_datetime(read_series(f"{local_folder}/{symbol}_{granularity}.pkl"))
+
+
+def stored_components(filename, local_folder):
+    # price_components of the stored series from the index, the series itself
+    # when it is not indexed, None when nothing is stored
+    if not os.path.exists(filename):
+        return None
+    entry = fresh_entry(local_folder, Path(filename).stem)
+    if entry is not None:
+        return entry.get('price_components')
+    return read_series(filename).attrs.get('price_components')
+
+
+def dropped_components(stored, price):
+    # Sides of the stored series a download of price would not bring back,
+    # mid counts as kept when bid and ask are both fetched
+    kept = set(price) | ({'M'} if {'B', 'A'} <= set(price) else set())
+    return ''.join(c for c in (stored or '') if c not in kept)
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// BATCH GET CANDLES //////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def get_hist_quotes(adapter: BrokerAdapter
+                    , symbol_lst
+                    , granularity_lst
+                    , date_start
+                    , date_end
+                    , price = 'BA'
+                    , workers = None
+                    , replace_sides = False
+                    ):
+    # One job per symbol/granularity, as many side by side as the adapter's
+    # strategy allows unless workers overrides it
+    strategy = fetch_strategy(adapter)
+    workers = strategy['job_workers'] if workers is None else workers
+    jobs = [(symbol, granularity) for symbol in symbol_lst for granularity in granularity_lst]
+    print(f"get_hist_quotes() {adapter.name}: {len(jobs)} jobs, {strategy['mode']} paging, "
+          f"{workers} jobs x {strategy['window_workers']} windows in flight")
+
+    def run_job(job):
+        symbol, granularity = job
+        start_time = time.time()
+        print(f'Fetching data for {symbol}, granularity: {granularity}')
+
+        ok = collect_and_save_candles(adapter
+                                      , symbol
+                                      , granularity
+                                      , date_start
+                                      , date_end
+                                      , print_to_console = True
+                                      , price = price
+                                      , replace_sides = replace_sides
+                                      )
+
+        if ok:
+            min_to_complete = (time.time() - start_time)/60
+            print(f'Quotes saved for {symbol}_{granularity}, took {min_to_complete:.0f} minutes.')
+        else:
+            print(f'Error on {symbol}_{granularity}')
+        return ok
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run_job, jobs))
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// AUX FUNCTIONS //////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def drop_sort_df(df):
+    df.drop_duplicates(subset=['time'], inplace=True)
+    df.sort_values(by='time', inplace=True)
+    df.reset_index(drop=True, inplace=True)
+    return df
+
+
+def drop_extra_candles(df, date_start, date_end):
+    df = df[ (df['time'] >= date_start) & (df['time'] <= date_end)].copy()
+    return df
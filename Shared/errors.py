@@ -0,0 +1,134 @@
+import time
+import threading
+import requests
+from tenacity import retry, wait_exponential, retry_if_result
+from Shared.credentials import RATE_STATUS
+
+
+TRANSIENT    = 'transient'
+RATE_LIMITED = 'rate_limited'
+PERMANENT    = 'permanent'
+
+TRANSIENT_STATUS = [408, 425, 500, 502, 503, 504]
+
+TRANSIENT_EXCEPTIONS = (  requests.ConnectionError
+                        , requests.Timeout
+                        , requests.exceptions.ChunkedEncodingError
+                        , requests.exceptions.ContentDecodingError
+                        , requests.exceptions.JSONDecodeError
+                        )
+
+# Attempts per error class, first attempt included. Rate limited requests
+# are re-routed by the AccountPool, which already pauses the limited account.
+RETRY_BUDGETS = {  TRANSIENT    : 5
+                 , RATE_LIMITED : 4
+                 , PERMANENT    : 1
+                 }
+
+BREAKER_THRESHOLD = 3         # consecutive permanent failures that open a circuit
+BREAKER_COOLDOWN  = 15 * 60   # seconds a circuit stays open before one probe
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// CLASSIFICATION /////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def classify_status(status_code):
+    if status_code in RATE_STATUS:
+        return RATE_LIMITED
+    if status_code in TRANSIENT_STATUS or status_code >= 500:
+        return TRANSIENT
+    return PERMANENT
+
+
+def classify_exception(error):
+    return TRANSIENT if isinstance(error, TRANSIENT_EXCEPTIONS) else PERMANENT
+
+
+def response_body(response):
+    try:
+        return response.json()
+    except ValueError:
+        return response.text[:500]
+
+
+def request_error(error_class, status_code = None, body = None, **details):
+    return dict(error_class=error_class, status_code=status_code, response=body, **details)
+
+
+def error_class(result):
+    ok, data = result
+    if ok:
+        return None
+    if isinstance(data, dict):
+        return data.get('error_class', TRANSIENT)
+    return TRANSIENT
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// RETRY POLICY ///////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def is_retryable(result):
+    return error_class(result) not in [None, PERMANENT]
+
+
+def stop_by_class(retry_state):
+    result = retry_state.outcome.result()
+    return retry_state.attempt_number >= RETRY_BUDGETS.get(error_class(result), 1)
+
+
+def last_result(retry_state):
+    # Out of budget: hand back the last (False, error) instead of raising
+    return retry_state.outcome.result()
+
+
+request_retry = retry(wait=wait_exponential(multiplier=1, min=1, max=10)
+                      , stop=stop_by_class
+                      , retry=retry_if_result(is_retryable)
+                      , retry_error_callback=last_result
+                      )
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// CIRCUIT BREAKER ////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+class CircuitBreaker:
+
+    def __init__(self, threshold = BREAKER_THRESHOLD, cooldown = BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = {}
+        self.open_until = {}
+        self.lock = threading.Lock()
+
+    def is_open(self, key):
+        with self.lock:
+            return self.open_until.get(key, 0.0) > time.monotonic()
+
+    def record(self, key, result):
+        # Only permanent failures count, a success closes the circuit again.
+        # After the cooldown one probe goes through and reopens it on failure.
+        outcome = error_class(result)
+        with self.lock:
+            if outcome is None:
+                self.failures.pop(key, None)
+                self.open_until.pop(key, None)
+            elif outcome == PERMANENT:
+                self.failures[key] = self.failures.get(key, 0) + 1
+                if self.failures[key] >= self.threshold:
+                    self.open_until[key] = time.monotonic() + self.cooldown
+                    print(f'CircuitBreaker {key} failed permanently {self.failures[key]} times '
+                          f'--> open for {self.cooldown}s')
+
+    def rejected(self):
+        return False, request_error(PERMANENT, error='circuit open')
+
+    def stats(self):
+        with self.lock:
+            now = time.monotonic()
+            return [dict(key=key
+                         , failures=failures
+                         , open=self.open_until.get(key, 0.0) > now
+                         ) for key, failures in self.failures.items()]
@@ -0,0 +1,211 @@
+import os
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from Shared.storage import read_series, loads_series, write_series, codec_for
+from Shared.timeutils import as_epoch_ms, as_datetime
+
+
+FEATURES_FOLDER = 'features'
+FEATURES_VERSION = 1
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// FEATURES ///////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+# Each feature takes the stored frame and returns one value per row. lookback
+# is how many rows before the first new row the tail update has to include
+# for the new values to match a full recompute.
+
+def returns(df, field = 'mid_c', periods = 1):
+    values = df[field].to_numpy(dtype='float64')
+    out = np.full(len(values), np.nan)
+    out[periods:] = values[periods:] / values[:-periods] - 1
+    return out
+
+
+def spread(df, window = 20):
+    values = df['ask_c'].to_numpy(dtype='float64') - df['bid_c'].to_numpy(dtype='float64')
+    return pd.Series(values).rolling(window).mean().to_numpy()
+
+
+def atr(df, window = 14, side = 'mid'):
+    h = df[f'{side}_h'].to_numpy(dtype='float64')
+    l = df[f'{side}_l'].to_numpy(dtype='float64')
+    c = df[f'{side}_c'].to_numpy(dtype='float64')
+    prev_c = np.concatenate([[np.nan], c[:-1]])
+    tr = np.fmax(h - l, np.fmax(np.abs(h - prev_c), np.abs(l - prev_c)))
+    return pd.Series(tr).rolling(window).mean().to_numpy()
+
+
+def volatility(df, window = 20, field = 'mid_c'):
+    log_c = np.log(df[field].to_numpy(dtype='float64'))
+    log_returns = np.concatenate([[np.nan], np.diff(log_c)])
+    return pd.Series(log_returns).rolling(window).std().to_numpy()
+
+
+FEATURES = {  'returns'    : dict(compute=returns   , lookback=lambda p: p.get('periods', 1)
+                                  , columns=lambda p: [p.get('field', 'mid_c')])
+            , 'spread'     : dict(compute=spread    , lookback=lambda p: p.get('window', 20) - 1
+                                  , columns=lambda p: ['bid_c', 'ask_c'])
+            , 'atr'        : dict(compute=atr       , lookback=lambda p: p.get('window', 14)
+                                  , columns=lambda p: [f"{p.get('side', 'mid')}_{x}" for x in 'hlc'])
+            , 'volatility' : dict(compute=volatility, lookback=lambda p: p.get('window', 20)
+                                  , columns=lambda p: [p.get('field', 'mid_c')])
+            }
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// CACHE KEYS AND HASHES //////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def feature_key(feature, params):
+    return '_'.join([feature, *(f'{k}={params[k]}' for k in sorted(params))])
+
+
+def feature_file(local_folder, symbol, granularity, feature, params):
+    return Path(local_folder) / FEATURES_FOLDER / f'{symbol}_{granularity}' / f'{feature_key(feature, params)}.pkl'
+
+
+def file_hash(raw: bytes):
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+def prefix_hash(df, columns, rows):
+    # Hash of the input columns the cached values were computed from, so a
+    # restated bar anywhere in the history forces a full recompute
+    h = hashlib.blake2b(digest_size=16)
+    for column in ['time', *columns]:
+        h.update(np.ascontiguousarray(df[column].to_numpy()[:rows]).tobytes())
+    return h.hexdigest()
+
+
+def read_cached(filename):
+    if not os.path.exists(filename):
+        return None
+    try:
+        cached = read_series(filename)
+    except Exception as error:
+        print(f'read_cached() {filename} unreadable, recomputing --> {error}')
+        return None
+    if cached.attrs.get('version') != FEATURES_VERSION:
+        return None
+    return cached
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// FEATURE STORE //////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def compute_feature(df, feature, params, cached = None):
+    spec = FEATURES[feature]
+    columns = spec['columns'](params)
+    rows = len(df)
+
+    start = 0
+    if cached is not None:
+        n = cached.attrs['source_rows']
+        if n <= rows and cached.attrs['prefix_hash'] == prefix_hash(df, columns, n):
+            start = n
+        else:
+            print(f'compute_feature() {feature} source history changed --> full recompute')
+
+    if start == 0:
+        values = spec['compute'](df, **params)
+        out = pd.DataFrame({'time': df['time'].to_numpy(), feature: values})
+    elif start == rows:
+        out = cached
+    else:
+        offset = max(start - spec['lookback'](params), 0)
+        tail = df.iloc[offset:].reset_index(drop=True)
+        values = spec['compute'](tail, **params)[start - offset:]
+        new = pd.DataFrame({'time': tail['time'].to_numpy()[start - offset:], feature: values})
+        out = pd.concat([cached, new], ignore_index=True)
+
+    out.attrs = dict(version=FEATURES_VERSION
+                     , feature=feature
+                     , params=params
+                     , source_rows=rows
+                     , prefix_hash=prefix_hash(df, columns, rows)
+                     )
+    return out, start
+
+
+def get_feature(symbol
+                , granularity
+                , feature
+                , local_folder
+                , broker = None
+                , **params
+                ):
+    if feature not in FEATURES:
+        raise ValueError(f'feature must be one of {list(FEATURES)}, got {feature!r}')
+    series_file = Path(local_folder) / f'{symbol}_{granularity}.pkl'
+    filename = feature_file(local_folder, symbol, granularity, feature, params)
+
+    with open(series_file, 'rb') as f:
+        raw = f.read()
+    source_hash = file_hash(raw)
+    cached = read_cached(filename)
+    if cached is not None and cached.attrs.get('source_hash') == source_hash:
+        return as_datetime(cached)
+
+    df = as_epoch_ms(loads_series(raw))
+    out, start = compute_feature(df, feature, params, cached)
+    out.attrs['source_hash'] = source_hash
+
+    broker = broker or Path(local_folder).resolve().parent.name.replace('Broker_', '')
+    os.makedirs(filename.parent, exist_ok=True)
+    write_series(out, filename, *codec_for(broker, granularity), generations=0)
+    print(f'get_feature() {symbol}_{granularity} {feature_key(feature, params)} --> '
+          f'{len(out) - start} of {len(out)} rows computed')
+    return as_datetime(out)
+
+
+def get_features(symbol, granularity, specs, local_folder, broker = None):
+    # specs: [('atr', {'window': 14}), ('spread', {}), ...]
+    frames = [get_feature(symbol, granularity, feature, local_folder, broker, **params).set_index('time')
+              for feature, params in specs]
+    columns = [feature_key(feature, params) for feature, params in specs]
+    features = pd.concat(frames, axis=1)
+    features.columns = columns
+    return features.reset_index()
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// REFRESH ////////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def refresh_cached(filename, local_folder):
+    cached = read_cached(filename)
+    if cached is None:
+        return filename, False
+    series_name = Path(filename).parent.name
+    symbol, granularity = series_name.rsplit('_', 1)
+    if not os.path.exists(Path(local_folder) / f'{series_name}.pkl'):
+        return filename, False
+    get_feature(symbol, granularity, cached.attrs['feature'], local_folder, **cached.attrs['params'])
+    return filename, True
+
+
+def refresh_features(local_folder, workers = None):
+    # Brings every cached feature up to date with its series, e.g. after a download
+    files = sorted((Path(local_folder) / FEATURES_FOLDER).glob('*/*.pkl'))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(refresh_cached, files, [local_folder] * len(files)))
+    print(f'refresh_features() {local_folder}: {sum(ok for _, ok in results)} of {len(files)} features refreshed')
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Bring cached features up to date with the vault')
+    arg_parser.add_argument('local_folder', nargs='+')
+    arg_parser.add_argument('--workers', type=int, default=None)
+    args = arg_parser.parse_args()
+
+    for local_folder in args.local_folder:
+        refresh_features(local_folder, args.workers)
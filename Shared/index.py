@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from Shared.locks import file_lock
+
+# Only the standard library is imported here so metadata queries (coverage,
+# status) start in milliseconds. Frames are passed in by the callers that
+# already have pandas loaded; refresh_index imports the readers on demand.
+
+INDEX_FILE = 'refs/vault_index.json'
+INDEX_LOCK = threading.Lock()
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// INDEX FILE /////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def index_file(local_folder):
+    return Path(local_folder) / INDEX_FILE
+
+
+def load_index(local_folder):
+    filename = index_file(local_folder)
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def save_index(index, local_folder):
+    filename = index_file(local_folder)
+    os.makedirs(filename.parent, exist_ok=True)
+    tmp_filename = f'{filename}.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(index, f, indent=4, sort_keys=True)
+    os.replace(tmp_filename, filename)
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// ENTRIES ////////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def series_entry(df, filename):
+    # df['time'] is int64 epoch ms, as written by save_to_file
+    stat = os.stat(filename)
+    rows = len(df)
+    return dict(rows=rows
+                , time_from=int(df['time'].min()) if rows > 0 else None
+                , time_to=int(df['time'].max()) if rows > 0 else None
+                , price_components=df.attrs.get('price_components')
+                , size=stat.st_size
+                , mtime_ns=stat.st_mtime_ns
+                )
+
+
+def is_stale(entry, filename):
+    if not os.path.exists(filename):
+        return True
+    stat = os.stat(filename)
+    return entry.get('size') != stat.st_size or entry.get('mtime_ns') != stat.st_mtime_ns
+
+
+def index_lock(local_folder):
+    return file_lock(f'{index_file(local_folder)}.lock')
+
+
+def update_index(df, filename, local_folder):
+    with INDEX_LOCK, index_lock(local_folder):
+        index = load_index(local_folder)
+        index[Path(filename).stem] = series_entry(df, filename)
+        save_index(index, local_folder)
+
+
+def remove_from_index(filename, local_folder):
+    with INDEX_LOCK, index_lock(local_folder):
+        index = load_index(local_folder)
+        if index.pop(Path(filename).stem, None) is not None:
+            save_index(index, local_folder)
+
+
+def refresh_index(local_folder, force = False):
+    # Re-reads only series that are new or changed since they were indexed
+    from Shared.storage import read_series
+    from Shared.timeutils import as_epoch_ms
+
+    if not os.path.exists(local_folder):
+        return {}
+    with INDEX_LOCK, index_lock(local_folder):
+        index = load_index(local_folder)
+        files = {f.stem: f for f in sorted(Path(local_folder).glob('*.pkl'))}
+        dropped = [key for key in index if key not in files]
+        for key in dropped:
+            del index[key]
+        refreshed = 0
+        for key, filename in files.items():
+            if force or key not in index or is_stale(index[key], filename):
+                index[key] = series_entry(as_epoch_ms(read_series(filename)), filename)
+                refreshed += 1
+        save_index(index, local_folder)
+    print(f'refresh_index() {local_folder}: {refreshed} series indexed, {len(dropped)} dropped, '
+          f'{len(index)} total')
+    return index
+
+
+def fresh_entry(local_folder, key):
+    entry = load_index(local_folder).get(key)
+    if entry is None or is_stale(entry, Path(local_folder) / f'{key}.pkl'):
+        return None
+    return entry
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// QUERIES ////////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def format_ms(ms):
+    if ms is None:
+        return '-'
+    return time.strftime('%Y-%m-%d %H:%M', time.gmtime(ms / 1000))
+
+
+def coverage(local_folder, symbol = None, granularity = None):
+    index = load_index(local_folder)
+    keys = set(index) | {f.stem for f in Path(local_folder).glob('*.pkl')}
+    rows = []
+    for key in sorted(keys):
+        key_symbol, key_granularity = key.rsplit('_', 1)
+        if symbol is not None and key_symbol != symbol:
+            continue
+        if granularity is not None and key_granularity != granularity:
+            continue
+        filename = Path(local_folder) / f'{key}.pkl'
+        entry = index.get(key)
+        if entry is None:
+            status = 'unindexed'
+            entry = {}
+        elif not os.path.exists(filename):
+            status = 'missing'
+        else:
+            status = 'stale' if is_stale(entry, filename) else 'ok'
+        rows.append(dict(symbol=key_symbol
+                         , granularity=key_granularity
+                         , rows=entry.get('rows')
+                         , time_from=entry.get('time_from')
+                         , time_to=entry.get('time_to')
+                         , size=entry.get('size')
+                         , status=status
+                         ))
+    return rows
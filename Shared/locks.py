@@ -0,0 +1,69 @@
+import os
+import time
+from pathlib import Path
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+LOCKS_FOLDER = '.locks'
+LOCK_POLL = 0.1     # seconds between attempts on platforms without blocking locks
+
+
+class LockBusy(Exception):
+    pass
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// FILE LOCKS /////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def try_lock(fd, blocking):
+    if fcntl is not None:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+    while True:
+        try:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            if not blocking:
+                return False
+            time.sleep(LOCK_POLL)
+
+
+def unlock(fd):
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def file_lock(lock_file, blocking = True):
+    # Advisory lock held through an open file, released by the OS if the
+    # process dies. Raises LockBusy when blocking is False and it is taken.
+    os.makedirs(Path(lock_file).parent, exist_ok=True)
+    fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if not try_lock(fd, blocking):
+            raise LockBusy(lock_file)
+        try:
+            yield
+        finally:
+            unlock(fd)
+    finally:
+        os.close(fd)
+
+
+def series_lock(filename, blocking = True):
+    # One lock per {symbol}_{granularity} of a vault, shared by every writer
+    filename = Path(filename)
+    return file_lock(filename.parent / LOCKS_FOLDER / f'{filename.stem}.lock', blocking)
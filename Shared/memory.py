@@ -0,0 +1,213 @@
+import os
+import time
+import uuid
+import psutil
+import threading
+import pandas as pd
+from pathlib import Path
+from contextlib import contextmanager
+from Shared.storage import dumps_series, loads_series
+from Shared.validation import GRANULARITY_SECONDS
+
+
+# One governor per process. Jobs reserve an estimate of their peak memory
+# before the heavy stages (download, concat, validate, save) and wait while
+# the reservations of running jobs would exceed the budget. Buffered chunks
+# are spilled to disk when a job outgrows its reservation or the machine
+# runs low on memory.
+
+MEMORY_BUDGET = None            # bytes all jobs may reserve, None takes MEMORY_SHARE of the RAM available
+MEMORY_SHARE = 0.6
+MIN_AVAILABLE = 512 * 1024**2   # below this much free RAM every buffer spills
+SPILL_FOLDER = '.spill'
+
+CANDLE_COLUMNS = 14             # time, volume and mid/bid/ask OHLC
+JOB_COPIES = 3                  # buffered chunks, the concatenated frame and the stored copy being written
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// GOVERNOR ///////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+class MemoryGovernor:
+
+    def __init__(self, budget = MEMORY_BUDGET):
+        self.budget = budget or int(psutil.virtual_memory().available * MEMORY_SHARE)
+        self.condition = threading.Condition()
+        self.jobs = {}      # (job, thread) -> usage, reservation, waits and nesting depth
+
+    def reserved_bytes(self):
+        return sum(j['reserved'] for j in self.jobs.values())
+
+    def reserve(self, key, nbytes):
+        # A job larger than the budget is admitted once it runs alone, it
+        # then relies on spilling
+        job = key[0]
+        start = time.monotonic()
+        with self.condition:
+            logged = False
+            while self.jobs and self.reserved_bytes() + nbytes > self.budget:
+                if not logged:
+                    print(f'MemoryGovernor {job} waiting for {nbytes / 1024**2:,.0f} MB, '
+                          f'{self.reserved_bytes() / 1024**2:,.0f} of {self.budget / 1024**2:,.0f} MB reserved')
+                    logged = True
+                self.condition.wait()
+            self.jobs[key] = dict(reserved=nbytes, buffered=0, spilled=0, peak=0, depth=1
+                                  , waited=time.monotonic() - start, started=time.monotonic())
+
+    def release(self, key):
+        with self.condition:
+            entry = self.jobs.get(key)
+            if entry is None:
+                return
+            entry['depth'] -= 1
+            if entry['depth'] == 0:
+                del self.jobs[key]
+                self.condition.notify_all()
+
+    @contextmanager
+    def reservation(self, job, nbytes):
+        # Re-entrant per job and thread, so a heavy stage called from a job
+        # that already holds its reservation does not count twice. Another
+        # thread working on the same series gets its own reservation.
+        key = job_key(job)
+        with self.condition:
+            entry = self.jobs.get(key)
+            if entry is not None:
+                entry['depth'] += 1
+        if entry is None:
+            self.reserve(key, nbytes)
+        try:
+            yield self.jobs[key]
+        finally:
+            self.release(key)
+
+    def track(self, key, nbytes, spilled = 0):
+        with self.condition:
+            entry = self.jobs.get(key)
+            if entry is not None:
+                entry['buffered'] += nbytes
+                entry['spilled'] += spilled
+                entry['peak'] = max(entry['peak'], entry['buffered'])
+
+    def under_pressure(self, key):
+        with self.condition:
+            entry = self.jobs.get(key)
+        if entry is not None and entry['buffered'] > entry['reserved'] / JOB_COPIES:
+            return True
+        return psutil.virtual_memory().available < MIN_AVAILABLE
+
+    def stats(self):
+        with self.condition:
+            now = time.monotonic()
+            return dict(budget=self.budget
+                        , reserved=self.reserved_bytes()
+                        , rss=psutil.Process().memory_info().rss
+                        , available=psutil.virtual_memory().available
+                        , jobs={f'{job}@{thread}': dict(reserved=j['reserved']
+                                          , buffered=j['buffered']
+                                          , peak=j['peak']
+                                          , spilled=j['spilled']
+                                          , waited=j['waited']
+                                          , running=now - j['started']
+                                          ) for (job, thread), j in self.jobs.items()}
+                        )
+
+
+GOVERNOR = None
+GOVERNOR_LOCK = threading.Lock()
+
+
+def job_key(job):
+    return job, threading.get_ident()
+
+
+def governor():
+    global GOVERNOR
+    with GOVERNOR_LOCK:
+        if GOVERNOR is None:
+            GOVERNOR = MemoryGovernor()
+        return GOVERNOR
+
+
+def estimate_job_bytes(granularity, date_start, date_end, columns = CANDLE_COLUMNS):
+    # Calendar bars, an upper bound for instruments that close
+    span = (pd.Timestamp(date_end) - pd.Timestamp(date_start)).total_seconds()
+    bars = max(span / GRANULARITY_SECONDS.get(granularity, 60), 1)
+    return int(bars * columns * 8 * JOB_COPIES)
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// CHUNK BUFFER ///////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+class ChunkBuffer:
+    # Downloaded chunks of one job, in memory until the governor reports
+    # pressure, then written uncompressed under {local_folder}/.spill/
+
+    def __init__(self, job, local_folder, memory_governor = None):
+        self.job = job
+        self.key = job_key(job)     # the reservation of the thread creating the buffer
+        self.governor = memory_governor or governor()
+        self.spill_folder = Path(local_folder) / SPILL_FOLDER
+        self.prefix = f"{job.replace('/', '_')}.{os.getpid()}.{uuid.uuid4().hex[:8]}"
+        self.items = []     # DataFrame in memory or spilled file name, in append order
+        self.orders = []    # sort key of each item for concat, the append order unless given
+        self.nbytes = {}    # id of an in-memory frame -> tracked bytes
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def append(self, df, order = None):
+        nbytes = int(df.memory_usage(index=True).sum())
+        with self.lock:
+            self.orders.append(len(self.orders) if order is None else order)
+            self.items.append(df)
+            self.nbytes[id(df)] = nbytes
+        self.governor.track(self.key, nbytes)
+        if self.governor.under_pressure(self.key):
+            self.spill()
+
+    def spill(self):
+        with self.lock:
+            os.makedirs(self.spill_folder, exist_ok=True)
+            freed = 0
+            for n, item in enumerate(self.items):
+                if isinstance(item, pd.DataFrame):
+                    filename = self.spill_folder / f'{self.prefix}.{n}.pkl'
+                    with open(filename, 'wb') as f:
+                        f.write(dumps_series(item, 'none'))
+                    self.items[n] = filename
+                    freed += self.nbytes.pop(id(item))
+        if freed:
+            self.governor.track(self.key, -freed, spilled=freed)
+
+    def frames(self):
+        for n in sorted(range(len(self.items)), key=self.orders.__getitem__):
+            item = self.items[n]
+            if isinstance(item, pd.DataFrame):
+                yield item
+            else:
+                with open(item, 'rb') as f:
+                    yield loads_series(f.read())
+
+    def concat(self):
+        # Spilled chunks are read back for the concat, the buffer is emptied
+        # and its spill files removed before the result is returned
+        frames = list(self.frames())
+        self.close()
+        return pd.concat(frames)
+
+    def close(self):
+        with self.lock:
+            freed = sum(self.nbytes.values())
+            for item in self.items:
+                if not isinstance(item, pd.DataFrame):
+                    try:
+                        os.remove(item)
+                    except FileNotFoundError:
+                        pass
+            self.items, self.orders, self.nbytes = [], [], {}
+        if freed:
+            self.governor.track(self.key, -freed)
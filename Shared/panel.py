@@ -0,0 +1,188 @@
+import os
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ProcessPoolExecutor
+from Shared.storage import read_series
+from Shared.validation import GRANULARITY_SECONDS
+from Shared.timeutils import time_as_ns
+
+
+PANEL_FIELDS = [ f'{price}_{item}'
+                 for price in ['bid', 'ask', 'mid']
+                 for item in ['o', 'h', 'l', 'c']
+               ]
+
+GRIDS      = ['union', 'intersection', 'regular']
+FILL_RULES = ['ffill', 'zero', 'none']
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// WORKERS ////////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def load_series_to_shm(filename, fields, start_ns=None, end_ns=None):
+    # Runs in a pool worker: the series is written into a shared memory block
+    # as [int64 time | float64 rows x fields] and only the block name travels
+    # back to the parent, so the frame itself is never pickled between processes
+    if not os.path.exists(filename):
+        return None, -1
+
+    df = read_series(filename)
+    t = time_as_ns(df)
+    keep = np.ones(len(t), dtype=bool)
+    if start_ns is not None:
+        keep &= t >= start_ns
+    if end_ns is not None:
+        keep &= t <= end_ns
+    rows = int(keep.sum())
+    if rows == 0:
+        return None, 0
+
+    shm = SharedMemory(create=True, size=rows * 8 * (1 + len(fields)), track=False)
+    try:
+        write_series_to_shm(shm, t[keep], df.reindex(columns=fields).to_numpy(dtype='float64')[keep])
+    except Exception:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    return shm.name, rows
+
+
+def write_series_to_shm(shm, t, values):
+    shm_times, shm_values = shm_views(shm, len(t), values.shape[1])
+    shm_times[:] = t
+    shm_values[:] = values
+
+
+def shm_views(shm, rows, n_fields):
+    times = np.ndarray((rows,), dtype='int64', buffer=shm.buf)
+    values = np.ndarray((rows, n_fields), dtype='float64', buffer=shm.buf, offset=rows * 8)
+    return times, values
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// ALIGNMENT //////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def make_grid(times_lst, grid, granularity):
+    if grid == 'union':
+        return np.unique(np.concatenate(times_lst))
+    if grid == 'intersection':
+        common = times_lst[0]
+        for t in times_lst[1:]:
+            common = np.intersect1d(common, t, assume_unique=True)
+        return common
+    if grid == 'regular':
+        step = GRANULARITY_SECONDS[granularity] * 10**9
+        t_min = min(t[0] for t in times_lst)
+        t_max = max(t[-1] for t in times_lst)
+        return np.arange(t_min - t_min % step, t_max + 1, step, dtype='int64')
+    raise ValueError(f'grid must be one of {GRIDS}, got {grid!r}')
+
+
+def align_series(series, grid, granularity, n_fields):
+    times = make_grid([t for t, _ in series], grid, granularity)
+    panel = np.full((len(series), len(times), n_fields), np.nan)
+    observed = np.zeros((len(series), len(times)), dtype=bool)
+    for s, (t, values) in enumerate(series):
+        idx = np.searchsorted(times, t)
+        on_grid = idx < len(times)
+        on_grid[on_grid] = times[idx[on_grid]] == t[on_grid]
+        panel[s, idx[on_grid]] = values[on_grid]
+        observed[s, idx[on_grid]] = True
+    return times, panel, observed
+
+
+def ffill_positions(observed):
+    # observed: (symbols, time) bool -> index of the last observed row per cell
+    positions = np.where(observed, np.arange(observed.shape[1]), 0)
+    np.maximum.accumulate(positions, axis=1, out=positions)
+    return positions
+
+
+def apply_fill(panel, observed, fields, fill):
+    rules = fill if isinstance(fill, dict) else {field: fill for field in fields}
+    positions = None
+    for f, field in enumerate(fields):
+        rule = rules.get(field, 'none')
+        if rule == 'none':
+            continue
+        if rule == 'zero':
+            panel[:, :, f][~observed] = 0.0
+        elif rule == 'ffill':
+            if positions is None:
+                positions = ffill_positions(observed)
+                started = np.maximum.accumulate(observed, axis=1)
+                rows = np.arange(panel.shape[0])[:, None]
+            filled = panel[rows, positions, f]
+            filled[~started] = np.nan
+            panel[:, :, f] = filled
+        else:
+            raise ValueError(f'fill rule must be one of {FILL_RULES}, got {rule!r}')
+    return panel
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// PANEL LOADER ///////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def load_panel(symbol_lst
+               , granularity
+               , local_folder
+               , fields = PANEL_FIELDS
+               , date_start = None
+               , date_end = None
+               , grid = 'union'
+               , fill = 'ffill'
+               , workers = None
+               , as_array = False
+               ):
+    fields = list(fields)
+    start_ns = None if date_start is None else pd.Timestamp(date_start, tz='UTC').value
+    end_ns = None if date_end is None else pd.Timestamp(date_end, tz='UTC').value
+    filenames = [Path(local_folder) / f'{symbol}_{granularity}.pkl' for symbol in symbol_lst]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        blocks = list(executor.map(load_series_to_shm
+                                   , filenames
+                                   , [fields] * len(filenames)
+                                   , [start_ns] * len(filenames)
+                                   , [end_ns] * len(filenames)
+                                   ))
+
+    symbols, series, attached = [], [], []
+    for symbol, (name, rows) in zip(symbol_lst, blocks):
+        if name is None:
+            reason = 'file not found' if rows < 0 else 'no rows in range'
+            print(f'load_panel() skipping {symbol}_{granularity} --> {reason}')
+            continue
+        shm = SharedMemory(name=name)
+        attached.append(shm)
+        symbols.append(symbol)
+        series.append(shm_views(shm, rows, len(fields)))
+
+    if len(series) == 0:
+        print(f'load_panel() no data for {granularity}')
+        return None
+
+    try:
+        times, panel, observed = align_series(series, grid, granularity, len(fields))
+    finally:
+        series.clear()
+        for shm in attached:
+            shm.close()
+            shm.unlink()
+
+    panel = apply_fill(panel, observed, fields, fill)
+    # Naive UTC at ms resolution, as as_datetime gives a single series
+    time_index = pd.DatetimeIndex(np.asarray(times, dtype='int64').view('datetime64[ns]').astype('datetime64[ms]'))
+
+    if as_array:
+        return panel, symbols, time_index, fields
+
+    columns = pd.MultiIndex.from_product([symbols, fields], names=['symbol', 'field'])
+    data = panel.transpose(1, 0, 2).reshape(len(times), len(symbols) * len(fields))
+    return pd.DataFrame(data, index=pd.Index(time_index, name='time'), columns=columns)
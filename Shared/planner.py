@@ -0,0 +1,254 @@
+import os
+import json
+import heapq
+import argparse
+import datetime as dt
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from dateutil import parser
+from Shared.storage import read_series
+from Shared.index import fresh_entry
+from Shared.adapters import ADAPTERS
+from Shared.timeutils import epoch_ms
+from Shared.validation import GRANULARITY_SECONDS, REPORTS_FOLDER
+
+
+ROOT = Path(__file__).parent.parent
+
+# Request limits, paging and rate limits come from Shared.adapters.ADAPTERS,
+# these are the planner's own assumptions per broker
+BROKERS = {  'FxOpen' : dict(bytes_per_bar = 110      # per price side, JSON
+                             , catalog = ROOT / 'Broker_FxOpen' / 'hist_quotes' / 'refs' / 'tradables_dict.json'
+                             )
+           , 'Oanda'  : dict(bytes_per_bar = 75       # per price side, JSON
+                             , catalog = None
+                             )
+           }
+
+REQUEST_LATENCY = 0.35      # assumed seconds per HTTP round trip
+
+# Share of calendar time with bars, by FxOpen StatusGroupId
+SESSION_SHARE = {  'Forex'     : 5 / 7
+                 , 'Crypto'    : 1.0
+                 , 'CFD 00-01' : 23 * 5 / (24 * 7)
+                 , 'US Stocks' : 6.5 * 5 / (24 * 7)
+                 }
+DEFAULT_SESSION_SHARE = 5 / 7
+
+# The engine downloads the whole requested range and save_to_file replaces the
+# stored series with it, so a plan always covers every window
+STRATEGIES = ['full']
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// INPUTS /////////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def load_catalog(broker):
+    catalog_file = BROKERS[broker]['catalog']
+    if catalog_file is None or not os.path.exists(catalog_file):
+        return None
+    with open(catalog_file, 'r') as f:
+        return json.load(f)
+
+
+def local_coverage(broker, symbol, granularity):
+    # Prefers the vault index, then the validation report written next to the
+    # series, falls back to reading the series when both are missing or stale
+    local_folder = Path(ADAPTERS[broker].local_folder)
+    filename = local_folder / f'{symbol}_{granularity}.pkl'
+    if not os.path.exists(filename):
+        return None
+    entry = fresh_entry(local_folder, f'{symbol}_{granularity}')
+    if entry is not None and entry['time_from'] is not None:
+        return entry['time_from'], entry['time_to']
+    report_file = local_folder / REPORTS_FOLDER / f'{symbol}_{granularity}.json'
+    if os.path.exists(report_file) and os.path.getmtime(report_file) >= os.path.getmtime(filename):
+        with open(report_file, 'r') as f:
+            report = json.load(f)
+        if report.get('time_from') is not None:
+            return pd.Timestamp(report['time_from']).value // 10**6, pd.Timestamp(report['time_to']).value // 10**6
+    t = epoch_ms(read_series(filename)['time'])
+    if len(t) == 0:
+        return None
+    return int(t.min()), int(t.max())
+
+
+def last_allowed_ms():
+    yesterday = dt.date.today() - dt.timedelta(days=1)
+    return int(pd.Timestamp(yesterday).value // 10**6)
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// WINDOWS ////////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def request_windows(broker, granularity, start_ms, end_ms):
+    # Same stepping as Shared.engine: max_candles bars per request, capped at
+    # the last allowed date. Cursor paging brokers (FxOpen) skip over market
+    # closures and may need fewer requests.
+    step = GRANULARITY_SECONDS[granularity] * ADAPTERS[broker].max_candles * 1000
+    end_ms = min(end_ms, last_allowed_ms())
+    if start_ms >= end_ms:
+        return np.empty((0, 2), dtype='int64')
+    starts = np.arange(start_ms, end_ms, step, dtype='int64')
+    return np.column_stack([starts, np.minimum(starts + step, end_ms)])
+
+
+def plan_job(broker, symbol, granularity, date_start, date_end, price, strategy, catalog):
+    start_ms = pd.Timestamp(parser.parse(date_start)).value // 10**6
+    end_ms = pd.Timestamp(parser.parse(date_end)).value // 10**6
+    settings = BROKERS[broker]
+    adapter = ADAPTERS[broker]
+
+    windows = request_windows(broker, granularity, start_ms, end_ms)
+    # A series already stored is replaced by the download, not extended
+    coverage = local_coverage(broker, symbol, granularity)
+
+    share = DEFAULT_SESSION_SHARE
+    known = True
+    if catalog is not None:
+        known = symbol in catalog
+        share = SESSION_SHARE.get(catalog.get(symbol, {}).get('StatusGroupId'), share)
+
+    chunks = len(windows)
+    sides = len([c for c in adapter.price_sides if c in price.upper()])
+    requests = chunks * adapter.requests_per_window(price)
+    span_s = float((windows[:, 1] - windows[:, 0]).sum()) / 1000
+    bars = span_s / GRANULARITY_SECONDS[granularity] * share
+    est_bytes = bars * settings['bytes_per_bar'] * sides
+    per_request = max(REQUEST_LATENCY, adapter.rate_limit)
+    window_workers = adapter.concurrency if adapter.paging == 'range' else 1
+    est_seconds = requests * per_request / max(window_workers, 1)
+
+    return dict(broker=broker
+                , symbol=symbol
+                , granularity=granularity
+                , known_symbol=known
+                , covered=coverage is not None
+                , chunks=chunks
+                , requests=requests
+                , est_bars=int(bars)
+                , est_bytes=int(est_bytes)
+                , est_seconds=est_seconds
+                , windows=windows
+                )
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// PLAN ///////////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def schedule_seconds(job_seconds, workers, total_requests, accounts, throttle):
+    # Longest jobs first onto the least busy worker, bounded below by what
+    # the accounts can serve given their request spacing
+    finish = [0.0] * max(workers, 1)
+    for seconds in sorted(job_seconds, reverse=True):
+        heapq.heapreplace(finish, finish[0] + seconds)
+    account_bound = total_requests * throttle / max(accounts, 1)
+    return max(max(finish), account_bound)
+
+
+def plan_backfill(jobs
+                  , workers = 1
+                  , accounts = 1
+                  , strategy = 'full'
+                  , print_to_console = True
+                  ):
+    if strategy not in STRATEGIES:
+        raise ValueError(f'strategy must be one of {STRATEGIES}, got {strategy!r}')
+
+    catalogs = {}
+    rows = []
+    for job in jobs:
+        broker = job['broker']
+        if broker not in catalogs:
+            catalogs[broker] = load_catalog(broker)
+        for symbol in job['symbol_lst']:
+            for granularity in job['granularity_lst']:
+                rows.append(plan_job(broker
+                                     , symbol
+                                     , granularity
+                                     , job['date_start']
+                                     , job['date_end']
+                                     , job.get('price', 'BA')
+                                     , strategy
+                                     , catalogs[broker]
+                                     ))
+
+    plan = pd.DataFrame(rows)
+    summary = []
+    for broker, group in plan.groupby('broker'):
+        summary.append(dict(broker=broker
+                            , jobs=len(group)
+                            , requests=int(group['requests'].sum())
+                            , est_mb=group['est_bytes'].sum() / 1024**2
+                            , est_hours=schedule_seconds(group['est_seconds'].tolist()
+                                                         , workers
+                                                         , int(group['requests'].sum())
+                                                         , accounts
+                                                         , ADAPTERS[broker].rate_limit
+                                                         ) / 3600
+                            , unknown_symbols=int((~group['known_symbol']).sum())
+                            ))
+    summary = pd.DataFrame(summary)
+
+    if print_to_console:
+        print(f'plan_backfill() strategy: {strategy}, workers: {workers}, accounts: {accounts}')
+        print(summary.to_string(index=False, float_format='%.2f'))
+    return plan, summary
+
+
+def compare_plans(jobs
+                  , workers_lst = (1, 2, 4, 8)
+                  , accounts_lst = (1,)
+                  , strategies = STRATEGIES
+                  ):
+    rows = []
+    for strategy in strategies:
+        for workers in workers_lst:
+            for accounts in accounts_lst:
+                _, summary = plan_backfill(jobs, workers, accounts, strategy, print_to_console=False)
+                summary.insert(0, 'strategy', strategy)
+                summary.insert(1, 'workers', workers)
+                summary.insert(2, 'accounts', accounts)
+                rows.append(summary)
+    comparison = pd.concat(rows, ignore_index=True)
+    print(comparison.to_string(index=False, float_format='%.2f'))
+    return comparison
+
+
+def plan_windows(plan):
+    rows = []
+    for _, job in plan.iterrows():
+        for start, end in job['windows']:
+            rows.append((job['broker'], job['symbol'], job['granularity'], start, end))
+    windows = pd.DataFrame(rows, columns=['broker', 'symbol', 'granularity', 'time_from', 'time_to'])
+    windows['time_from'] = pd.to_datetime(windows['time_from'], unit='ms')
+    windows['time_to'] = pd.to_datetime(windows['time_to'], unit='ms')
+    return windows
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Dry run a backfill: windows, requests, time and bytes, no network')
+    arg_parser.add_argument('broker', choices=list(BROKERS))
+    arg_parser.add_argument('--symbols', nargs='+', required=True)
+    arg_parser.add_argument('--granularities', nargs='+', required=True)
+    arg_parser.add_argument('--start', required=True)
+    arg_parser.add_argument('--end', required=True)
+    arg_parser.add_argument('--price', default='BA')
+    arg_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    arg_parser.add_argument('--accounts', type=int, nargs='+', default=[1])
+    arg_parser.add_argument('--strategy', choices=STRATEGIES, nargs='+', default=STRATEGIES)
+    args = arg_parser.parse_args()
+
+    jobs = [dict(broker=args.broker
+                 , symbol_lst=args.symbols
+                 , granularity_lst=args.granularities
+                 , date_start=args.start
+                 , date_end=args.end
+                 , price=args.price
+                 )]
+    compare_plans(jobs, args.workers, args.accounts, args.strategy)
@@ -0,0 +1,223 @@
+import os
+import json
+import sqlite3
+import hashlib
+import argparse
+import threading
+import pandas as pd
+from pathlib import Path
+from itertools import repeat
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from Shared.storage import read_series
+from Shared.timeutils import as_epoch_ms
+from Shared.locks import file_lock
+
+
+ROOT = Path(__file__).parent.parent
+
+VAULT_FOLDERS = {  'FxOpen' : ROOT / 'Broker_FxOpen' / 'hist_quotes'
+                 , 'Oanda'  : ROOT / 'Broker_Oanda' / 'hist_quotes'
+                 }
+
+CATALOG_FILE = 'refs/tradables_dict.json'
+
+# One SQLite file per broker and granularity under hist_quotes/sql/, holding
+# every symbol in a candles table clustered on (symbol, time)
+SQL_FOLDER = 'sql'
+QUERY_CACHE_SIZE = 64
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// PARTITIONS /////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def partition_file(local_folder, granularity):
+    return Path(local_folder) / SQL_FOLDER / f'{granularity}.sqlite'
+
+
+def open_partition(filename):
+    os.makedirs(Path(filename).parent, exist_ok=True)
+    conn = sqlite3.connect(filename)
+    conn.execute('PRAGMA journal_mode=WAL')      # readers are not blocked by a sync
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS _series '
+                 '(symbol TEXT PRIMARY KEY, rows INTEGER, size INTEGER, mtime_ns INTEGER)')
+    return conn
+
+
+def ensure_columns(conn, columns):
+    existing = [row[1] for row in conn.execute('PRAGMA table_info(candles)')]
+    if len(existing) == 0:
+        definitions = ', '.join(f'"{c}" REAL' for c in columns)
+        conn.execute(f'CREATE TABLE candles (symbol TEXT NOT NULL, time INTEGER NOT NULL, {definitions}, '
+                     f'PRIMARY KEY (symbol, time)) WITHOUT ROWID')
+        return
+    for column in columns:
+        if column not in existing:
+            conn.execute(f'ALTER TABLE candles ADD COLUMN "{column}" REAL')
+
+
+def write_partition_series(conn, symbol, df, size, mtime_ns):
+    columns = [c for c in df.columns if c != 'time']
+    ensure_columns(conn, columns)
+    names = ', '.join(['symbol', 'time', *(f'"{c}"' for c in columns)])
+    marks = ', '.join('?' * (len(columns) + 2))
+    with conn:
+        conn.execute('DELETE FROM candles WHERE symbol = ?', (symbol,))
+        conn.executemany(f'INSERT OR REPLACE INTO candles ({names}) VALUES ({marks})'
+                         , zip(repeat(symbol), df['time'].tolist(), *(df[c].tolist() for c in columns)))
+        conn.execute('INSERT OR REPLACE INTO _series VALUES (?, ?, ?, ?)', (symbol, len(df), size, mtime_ns))
+
+
+def load_series_file(filename):
+    return as_epoch_ms(read_series(filename))
+
+
+def partition_version(filename):
+    conn = sqlite3.connect(f'file:{filename}?mode=ro', uri=True)
+    try:
+        return conn.execute('SELECT count(*), sum(rows), max(mtime_ns) FROM _series').fetchone()
+    finally:
+        conn.close()
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// VAULT SQL //////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+class VaultSQL:
+
+    def __init__(self, vault_folders = VAULT_FOLDERS, cache_size = QUERY_CACHE_SIZE):
+        self.vault_folders = {k: Path(v) for k, v in vault_folders.items()}
+        self.cache_size = cache_size
+        self.cache = OrderedDict()      # query key -> DataFrame, least recently used first
+        self.lock = threading.Lock()
+
+    def partitions(self, brokers = None, granularities = None):
+        found = []
+        for broker, local_folder in self.vault_folders.items():
+            if brokers is not None and broker not in brokers:
+                continue
+            for filename in sorted((local_folder / SQL_FOLDER).glob('*.sqlite')):
+                if granularities is not None and filename.stem not in granularities:
+                    continue
+                found.append((broker, filename.stem, filename))
+        return found
+
+    def sync(self, brokers = None, workers = None):
+        # Mirrors new or changed pickles into the partitions, the only step
+        # that unpickles series. Unchanged series are skipped by size/mtime.
+        for broker, local_folder in self.vault_folders.items():
+            if brokers is not None and broker not in brokers:
+                continue
+            by_granularity = {}
+            for filename in sorted(local_folder.glob('*.pkl')):
+                symbol, granularity = filename.stem.rsplit('_', 1)
+                by_granularity.setdefault(granularity, {})[symbol] = filename
+
+            for granularity, files in by_granularity.items():
+                db_file = partition_file(local_folder, granularity)
+                with file_lock(f'{db_file}.lock'):
+                    conn = open_partition(db_file)
+                    try:
+                        known = {row[0]: row[1:] for row in conn.execute('SELECT symbol, size, mtime_ns FROM _series')}
+                        stats = {symbol: os.stat(f) for symbol, f in files.items()}
+                        changed = [symbol for symbol, stat in stats.items()
+                                   if known.get(symbol) != (stat.st_size, stat.st_mtime_ns)]
+                        removed = [symbol for symbol in known if symbol not in files]
+                        with conn:
+                            for symbol in removed:
+                                conn.execute('DELETE FROM candles WHERE symbol = ?', (symbol,))
+                                conn.execute('DELETE FROM _series WHERE symbol = ?', (symbol,))
+
+                        with ProcessPoolExecutor(max_workers=workers) as executor:
+                            frames = executor.map(load_series_file, [files[s] for s in changed])
+                            for symbol, df in zip(changed, frames):
+                                stat = stats[symbol]
+                                write_partition_series(conn, symbol, df, stat.st_size, stat.st_mtime_ns)
+                                print(f'VaultSQL.sync() {broker} {symbol}_{granularity} --> {len(df)} rows')
+                    finally:
+                        conn.close()
+                print(f'VaultSQL.sync() {broker} {granularity}: {len(changed)} series updated, '
+                      f'{len(removed)} removed, {len(files) - len(changed)} unchanged')
+
+    def connect(self, broker, granularity, filename):
+        # Read only connection with the partition exposed as the quotes view,
+        # broker and granularity as constant columns so filters on them prune
+        # whole partitions, and the instrument catalog as the instruments table
+        conn = sqlite3.connect(f'file:{filename}?mode=ro', uri=True)
+        conn.execute(f"CREATE TEMP VIEW quotes AS SELECT '{broker}' AS broker, '{granularity}' AS granularity, * "
+                     f"FROM candles")
+        conn.execute('CREATE TEMP TABLE instruments (symbol TEXT PRIMARY KEY, group_id TEXT)')
+        catalog_file = self.vault_folders[broker] / CATALOG_FILE
+        if os.path.exists(catalog_file):
+            with open(catalog_file, 'r') as f:
+                catalog = json.load(f)
+            conn.executemany('INSERT INTO instruments VALUES (?, ?)'
+                             , [(symbol, inst.get('StatusGroupId')) for symbol, inst in catalog.items()])
+        return conn
+
+    def query_partition(self, sql, params, partition):
+        broker, granularity, filename = partition
+        conn = self.connect(broker, granularity, filename)
+        try:
+            return pd.read_sql_query(sql, conn, params=params)
+        finally:
+            conn.close()
+
+    def query(self
+              , sql
+              , params = ()
+              , brokers = None
+              , granularities = None
+              , workers = None
+              , cache = True
+              ):
+        # The query runs in every selected partition in parallel and the results
+        # are stacked; aggregates therefore group within a broker/granularity
+        partitions = self.partitions(brokers, granularities)
+        if len(partitions) == 0:
+            print(f'VaultSQL.query() no partitions for brokers {brokers} granularities {granularities}, run sync first')
+            return pd.DataFrame()
+
+        versions = [(b, g, partition_version(f)) for b, g, f in partitions]
+        key = hashlib.blake2b(repr((sql, tuple(params), versions)).encode(), digest_size=16).hexdigest()
+        if cache:
+            with self.lock:
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    return self.cache[key].copy()
+
+        with ThreadPoolExecutor(max_workers=workers or len(partitions)) as executor:
+            results = list(executor.map(self.query_partition, repeat(sql), repeat(params), partitions))
+        result = pd.concat([r for r in results if len(r) > 0] or results[:1], ignore_index=True)
+
+        if cache:
+            with self.lock:
+                self.cache[key] = result
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return result.copy()
+
+    def clear_cache(self):
+        with self.lock:
+            self.cache.clear()
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description='SQL over the quote vaults')
+    arg_parser.add_argument('command', choices=['sync', 'query'])
+    arg_parser.add_argument('sql', nargs='?', help="e.g. \"SELECT symbol, avg(ask_c - bid_c) FROM quotes GROUP BY symbol\"")
+    arg_parser.add_argument('--broker', nargs='+', default=None)
+    arg_parser.add_argument('--granularity', nargs='+', default=None)
+    arg_parser.add_argument('--workers', type=int, default=None)
+    args = arg_parser.parse_args()
+
+    vault_sql = VaultSQL()
+    if args.command == 'sync':
+        vault_sql.sync(args.broker, args.workers)
+    else:
+        print(vault_sql.query(args.sql, brokers=args.broker, granularities=args.granularity
+                              , workers=args.workers).to_string(index=False))
@@ -0,0 +1,315 @@
+import os
+import json
+import random
+import hashlib
+import argparse
+import datetime as dt
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from Shared.snapshots import CHUNK_PERIODS, DAY_MS, period_keys
+from Shared.storage import read_series, write_series, codec_for
+from Shared.timeutils import as_epoch_ms
+from Shared.index import update_index
+from Shared.validation import validate_candles
+from Shared.locks import series_lock, file_lock
+
+
+# Digests of every time chunk of a series (a day for M1, a week for M5, a
+# month otherwise, the same cut as the snapshots) in hist_quotes/refs/digests/.
+# A verify run re-fetches a few chunks and compares both the stored and the
+# re-fetched chunk with the recorded digest: the broker restating a chunk and
+# the local copy no longer matching its digest are reported apart. Only
+# restated chunks, and damaged chunks the broker still serves as recorded, are
+# patched. Each mismatch is logged to reports/revisions.jsonl.
+DIGESTS_FOLDER = 'refs/digests'
+REVISIONS_LOG = 'reports/revisions.jsonl'
+VERIFY_CHUNKS = 4       # chunks re-fetched per series and run
+VERIFY_SELECTIONS = ['oldest', 'random', 'recent']
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// DIGESTS ////////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def digests_file(local_folder, series_name):
+    return Path(local_folder) / DIGESTS_FOLDER / f'{series_name}.json'
+
+
+def series_period(granularity):
+    return CHUNK_PERIODS.get(granularity, CHUNK_PERIODS['default'])
+
+
+def period_bounds(key, period):
+    # [start, end) of a chunk key in epoch ms
+    if period == 'day':
+        return key * DAY_MS, (key + 1) * DAY_MS
+    if period == 'week':
+        return (key * 7 - 3) * DAY_MS, (key * 7 + 4) * DAY_MS
+    months = np.array([key, key + 1]).astype('datetime64[M]').astype('datetime64[ms]').view('int64')
+    return int(months[0]), int(months[1])
+
+
+def chunk_digest(df, columns):
+    # time as int64 and every other column as float64, so a re-fetched frame
+    # hashes like the stored one whatever dtypes the API response came with
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.ascontiguousarray(df['time'].to_numpy(dtype='int64')).tobytes())
+    for column in columns:
+        h.update(np.ascontiguousarray(df[column].to_numpy(dtype='float64')).tobytes())
+    return h.hexdigest()
+
+
+def series_digests(df, granularity):
+    # df with epoch ms time, sorted
+    period = series_period(granularity)
+    columns = sorted(c for c in df.columns if c != 'time')
+    keys = period_keys(df['time'].to_numpy(dtype='int64'), period)
+    bounds = np.flatnonzero(np.diff(keys)) + 1
+    chunks = {}
+    for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(df)]):
+        if end > start:
+            chunks[str(keys[start])] = dict(rows=int(end - start)
+                                            , digest=chunk_digest(df.iloc[start:end], columns))
+    return dict(period=period, columns=columns, chunks=chunks)
+
+
+def load_digests(local_folder, series_name):
+    filename = digests_file(local_folder, series_name)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def save_digests(digests, local_folder, series_name):
+    filename = digests_file(local_folder, series_name)
+    os.makedirs(filename.parent, exist_ok=True)
+    tmp_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(digests, f)
+    os.replace(tmp_filename, filename)
+
+
+def record_digests(df, filename, local_folder):
+    # Called after every save, keeps when each unchanged chunk was last verified
+    series_name = Path(filename).stem
+    granularity = series_name.rsplit('_', 1)[1]
+    digests = series_digests(df, granularity)
+    previous = load_digests(local_folder, series_name) or dict(chunks={})
+    for key, chunk in digests['chunks'].items():
+        old = previous['chunks'].get(key)
+        if old is not None and old['digest'] == chunk['digest']:
+            chunk['verified'] = old.get('verified')
+    save_digests(digests, local_folder, series_name)
+    return digests
+
+
+def refresh_digests(local_folder, force = False):
+    # Digests for series stored before digests were recorded
+    local_folder = Path(local_folder)
+    done = 0
+    for filename in sorted(local_folder.glob('*.pkl')):
+        if not force and os.path.exists(digests_file(local_folder, filename.stem)):
+            continue
+        record_digests(as_epoch_ms(read_series(filename)), filename, local_folder)
+        done += 1
+    print(f'refresh_digests() {local_folder}: {done} series digested')
+    return done
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// VERIFY /////////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def select_chunks(digests, count = VERIFY_CHUNKS, selection = 'oldest', last_allowed_ms = None, seed = None):
+    # 'oldest' walks the history by least recently verified, so repeated runs
+    # cover every chunk in turn. 'random' samples, 'recent' re-checks the newest.
+    if selection not in VERIFY_SELECTIONS:
+        raise ValueError(f'selection must be one of {VERIFY_SELECTIONS}, got {selection!r}')
+    keys = [k for k in digests['chunks']
+            if last_allowed_ms is None or period_bounds(int(k), digests['period'])[1] <= last_allowed_ms]
+    if selection == 'random':
+        return sorted(random.Random(seed).sample(keys, min(count, len(keys))), key=int)
+    if selection == 'recent':
+        return sorted(keys, key=int)[-count:]
+    return sorted(sorted(keys, key=lambda k: (digests['chunks'][k].get('verified') or '', int(k)))[:count], key=int)
+
+
+def log_revision(local_folder, record):
+    filename = Path(local_folder) / REVISIONS_LOG
+    os.makedirs(filename.parent, exist_ok=True)
+    with file_lock(f'{filename}.lock'):
+        with open(filename, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def fetch_chunk(adapter, symbol, granularity, start_ms, end_ms, price):
+    from Shared import engine
+    date_start = pd.Timestamp(start_ms, unit='ms').isoformat()
+    date_end = pd.Timestamp(end_ms, unit='ms').isoformat()
+    ok, df = engine.collect_candles(adapter, symbol, granularity, date_start, date_end, False, price)
+    if not ok:
+        return None
+    df = as_epoch_ms(df)
+    return df[(df['time'] >= start_ms) & (df['time'] < end_ms)].reset_index(drop=True)
+
+
+def verify_series(adapter
+                  , symbol
+                  , granularity
+                  , count = VERIFY_CHUNKS
+                  , selection = 'oldest'
+                  , chunks = None
+                  , patch = True
+                  , seed = None
+                  ):
+    local_folder = Path(adapter.local_folder)
+    series_name = f'{symbol}_{granularity}'
+    filename = local_folder / f'{series_name}.pkl'
+    stored = as_epoch_ms(read_series(filename))
+    digests = load_digests(local_folder, series_name) or record_digests(stored, filename, local_folder)
+    price = stored.attrs.get('price_components') or ''.join(adapter.price_sides)
+    if chunks is None:
+        yesterday = dt.date.today() - dt.timedelta(days=1)
+        lad = int(pd.Timestamp(yesterday).value // 1_000_000)
+        chunks = select_chunks(digests, count, selection, lad, seed)
+    chunks = [str(key) for key in chunks if str(key) in digests['chunks']]
+
+    # Edge chunks are only compared over the stored range, a series that starts
+    # mid-month is not a revision of that month
+    first, last = int(stored['time'].iloc[0]), int(stored['time'].iloc[-1]) + 1
+    revised, local, verified, failed = {}, {}, [], []
+    for key in chunks:
+        start_ms, end_ms = period_bounds(int(key), digests['period'])
+        start_ms, end_ms = max(start_ms, first), min(end_ms, last)
+        fetched = fetch_chunk(adapter, symbol, granularity, start_ms, end_ms, price)
+        if fetched is None or len(fetched) == 0 or not set(digests['columns']) <= set(fetched.columns):
+            failed.append(key)
+            continue
+        fetched = fetched[['time', *digests['columns']]]
+        old = stored[(stored['time'] >= start_ms) & (stored['time'] < end_ms)]
+        recorded = digests['chunks'][key]['digest']
+        remote_ok = chunk_digest(fetched, digests['columns']) == recorded
+        if chunk_digest(old, digests['columns']) != recorded:
+            # The stored chunk changed since its digest was recorded
+            local[key] = (start_ms, end_ms, old, fetched, remote_ok)
+        elif remote_ok:
+            verified.append(key)
+        else:
+            revised[key] = (start_ms, end_ms, old, fetched)
+
+    # Restated chunks are replaced by the broker's version, damaged ones only
+    # when the broker still serves what the digest recorded
+    patches = {**revised, **{k: v[:4] for k, v in local.items() if v[4]}}
+
+    now = dt.datetime.now(dt.UTC).isoformat()
+    applied, rejected = False, {}
+    with series_lock(filename):
+        if patches and patch:
+            # Re-read under the lock, a download may have saved since
+            current = as_epoch_ms(read_series(filename))
+            keep = np.ones(len(current), dtype=bool)
+            for start_ms, end_ms, _, _ in patches.values():
+                keep &= ~((current['time'] >= start_ms) & (current['time'] < end_ms)).to_numpy()
+            patched = pd.concat([current[keep], *(f for *_, f in patches.values())], ignore_index=True)
+            patched = patched.sort_values('time', ignore_index=True)
+            patched.attrs = current.attrs
+            # A restatement is held to the same checks as a download, a series
+            # that would fail validation is left as stored
+            report = validate_candles(patched, granularity)
+            applied = report['passed']
+            if not applied:
+                rejected = {k: v['count'] for k, v in report['checks'].items() if v['count'] > 0}
+        if applied:
+            write_series(patched, filename, *codec_for(adapter.name, granularity))
+            update_index(patched, filename, local_folder)
+            digests = record_digests(patched, filename, local_folder)
+            verified += list(patches)
+        else:
+            digests = load_digests(local_folder, series_name) or digests
+
+        for key in verified:
+            if key in digests['chunks']:
+                digests['chunks'][key]['verified'] = now
+        save_digests(digests, local_folder, series_name)
+
+    mismatches = [(key, start_ms, end_ms, old, fetched, 'restated', False)
+                  for key, (start_ms, end_ms, old, fetched) in revised.items()]
+    mismatches += [(key, start_ms, end_ms, old, fetched, 'local', remote_ok)
+                   for key, (start_ms, end_ms, old, fetched, remote_ok) in local.items()]
+    for key, start_ms, end_ms, old, fetched, kind, remote_ok in sorted(mismatches, key=lambda m: int(m[0])):
+        merged = old.merge(fetched, on='time', how='outer', suffixes=('_old', '_new'), indicator=True)
+        both = merged[merged['_merge'] == 'both']
+        changed = np.zeros(len(both), dtype=bool)
+        for column in digests['columns']:
+            changed |= ~np.isclose(both[f'{column}_old'].to_numpy(dtype='float64')
+                                   , both[f'{column}_new'].to_numpy(dtype='float64'), rtol=0, atol=0, equal_nan=True)
+        record = dict(time=now
+                      , broker=adapter.name
+                      , series=series_name
+                      , chunk=key
+                      , kind=kind
+                      , start=pd.Timestamp(start_ms, unit='ms').isoformat()
+                      , end=pd.Timestamp(end_ms, unit='ms').isoformat()
+                      , rows_before=len(old)
+                      , rows_after=len(fetched)
+                      , rows_added=int((merged['_merge'] == 'right_only').sum())
+                      , rows_removed=int((merged['_merge'] == 'left_only').sum())
+                      , rows_changed=int(changed.sum())
+                      , patched=applied and key in patches
+                      )
+        if kind == 'local':
+            record.update(remote_matches_digest=remote_ok)
+        if patch and not applied and key in patches:
+            record.update(rejected=True, failed_checks=rejected)
+        log_revision(local_folder, record)
+        if kind == 'restated':
+            label = 'REVISED'
+        elif remote_ok:
+            label = 'LOCAL MISMATCH, the broker still serves the recorded chunk'
+        else:
+            label = 'LOCAL MISMATCH, the broker also differs from the recorded digest --> not patched'
+        print(f"verify_series() {series_name} chunk {record['start']} {label} >> "
+              f"{record['rows_changed']} changed, {record['rows_added']} added, {record['rows_removed']} removed"
+              f"{' --> patched' if record['patched'] else ''}"
+              f"{f' --> REJECTED, failed validation {rejected}' if record.get('rejected') else ''}")
+
+    print(f'verify_series() {series_name}: {len(chunks)} chunks checked, {len(revised)} revised, '
+          f'{len(local)} not matching their recorded digest, {len(failed)} not fetched')
+    return dict(checked=len(chunks), revised=sorted(revised, key=int), local=sorted(local, key=int), failed=failed
+                , rejected=sorted(patches, key=int) if patch and not applied else [])
+
+
+def verify_vault(adapter
+                 , symbol_lst = None
+                 , granularity_lst = None
+                 , count = VERIFY_CHUNKS
+                 , selection = 'oldest'
+                 , patch = True
+                 ):
+    results = {}
+    for filename in sorted(Path(adapter.local_folder).glob('*.pkl')):
+        symbol, granularity = filename.stem.rsplit('_', 1)
+        if symbol_lst is not None and symbol not in symbol_lst:
+            continue
+        if granularity_lst is not None and granularity not in granularity_lst:
+            continue
+        if adapter.blocked(symbol, granularity):
+            continue
+        results[filename.stem] = verify_series(adapter, symbol, granularity, count, selection, patch=patch)
+    revised = sum(len(r['revised']) for r in results.values())
+    checked = sum(r['checked'] for r in results.values())
+    print(f'verify_vault() {adapter.name}: {len(results)} series, {checked} chunks checked, {revised} revised')
+    return results
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Per-chunk digests of stored series')
+    arg_parser.add_argument('local_folder', nargs='+')
+    arg_parser.add_argument('--force', action='store_true', help='re-digest series that already have digests')
+    args = arg_parser.parse_args()
+
+    for local_folder in args.local_folder:
+        refresh_digests(local_folder, args.force)
@@ -0,0 +1,263 @@
+import os
+import json
+import hashlib
+import argparse
+import datetime as dt
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from Shared.storage import read_series, compress, decompress, codec_available
+from Shared.timeutils import as_epoch_ms, as_datetime
+from Shared.locks import file_lock
+
+
+SNAPSHOTS_FOLDER = 'snapshots'
+CHUNK_CODEC = ('zstd', 3) if codec_available('zstd') else ('gzip', 6)
+
+# Rows are cut into time chunks so a new snapshot only stores the chunks
+# that changed, e.g. one new day of M1 or the current month of H1
+CHUNK_PERIODS = {  'M1'      : 'day'
+                 , 'M5'      : 'week'
+                 , 'default' : 'month'
+                 }
+
+DAY_MS = 86_400_000
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// CHUNKS /////////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def snapshots_folder(local_folder):
+    return Path(local_folder) / SNAPSHOTS_FOLDER
+
+
+def chunk_file(local_folder, digest):
+    return snapshots_folder(local_folder) / 'chunks' / digest[:2] / digest
+
+
+def period_keys(time_ms, period):
+    days = time_ms // DAY_MS
+    if period == 'day':
+        return days
+    if period == 'week':
+        return (days + 3) // 7      # weeks start on Monday, 1970-01-01 was a Thursday
+    return time_ms.view('datetime64[ms]').astype('datetime64[M]').view('int64')
+
+
+def encode_chunk(df):
+    # Column bytes behind a small JSON header, deterministic for equal data so
+    # equal chunks hash the same whatever the frame's history
+    header = json.dumps([(c, str(df[c].dtype)) for c in df.columns]).encode()
+    parts = [len(header).to_bytes(4, 'little'), header]
+    parts += [np.ascontiguousarray(df[c].to_numpy()).tobytes() for c in df.columns]
+    return b''.join(parts)
+
+
+def decode_chunk(raw):
+    size = int.from_bytes(raw[:4], 'little')
+    columns = json.loads(raw[4:4 + size])
+    body = memoryview(raw)[4 + size:]
+    rows = len(body) // sum(np.dtype(dtype).itemsize for _, dtype in columns) if columns else 0
+    data, offset = {}, 0
+    for column, dtype in columns:
+        nbytes = rows * np.dtype(dtype).itemsize
+        data[column] = np.frombuffer(body[offset:offset + nbytes], dtype=dtype)
+        offset += nbytes
+    return pd.DataFrame(data)
+
+
+def store_chunk(local_folder, raw):
+    digest = hashlib.blake2b(raw, digest_size=20).hexdigest()
+    filename = chunk_file(local_folder, digest)
+    if not os.path.exists(filename):
+        os.makedirs(filename.parent, exist_ok=True)
+        tmp_filename = f'{filename}.{os.getpid()}.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(compress(raw, *CHUNK_CODEC))
+        os.replace(tmp_filename, filename)
+        return digest, len(raw)
+    return digest, 0
+
+
+def load_chunk(local_folder, digest):
+    with open(chunk_file(local_folder, digest), 'rb') as f:
+        return decode_chunk(decompress(f.read()))
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// SNAPSHOTS //////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def snapshot_series(filename, local_folder):
+    symbol, granularity = Path(filename).stem.rsplit('_', 1)
+    stat = os.stat(filename)
+    df = as_epoch_ms(read_series(filename))
+    period = CHUNK_PERIODS.get(granularity, CHUNK_PERIODS['default'])
+    keys = period_keys(df['time'].to_numpy(), period)
+    bounds = np.flatnonzero(np.diff(keys)) + 1
+    chunks, new_bytes = [], 0
+    for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(df)]):
+        digest, written = store_chunk(local_folder, encode_chunk(df.iloc[start:end]))
+        chunks.append(digest)
+        new_bytes += written
+    entry = dict(rows=len(df)
+                 , attrs=df.attrs
+                 , size=stat.st_size
+                 , mtime_ns=stat.st_mtime_ns
+                 , chunks=chunks
+                 )
+    return Path(filename).stem, entry, new_bytes
+
+
+def manifest_file(local_folder, snapshot_id):
+    return snapshots_folder(local_folder) / 'manifests' / f'{snapshot_id}.json'
+
+
+def list_snapshots(local_folder):
+    return sorted(f.stem for f in (snapshots_folder(local_folder) / 'manifests').glob('*.json'))
+
+
+def load_tags(local_folder):
+    tags_file = snapshots_folder(local_folder) / 'tags.json'
+    if not os.path.exists(tags_file):
+        return {}
+    with open(tags_file, 'r') as f:
+        return json.load(f)
+
+
+def save_tags(tags, local_folder):
+    tags_file = snapshots_folder(local_folder) / 'tags.json'
+    os.makedirs(tags_file.parent, exist_ok=True)
+    tmp_file = f'{tags_file}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(tags, f, indent=4, sort_keys=True)
+    os.replace(tmp_file, tags_file)
+
+
+def resolve_snapshot(local_folder, snapshot):
+    # A tag, a full id, or 'latest'
+    if snapshot == 'latest':
+        snapshots = list_snapshots(local_folder)
+        if len(snapshots) == 0:
+            raise ValueError(f'no snapshots in {local_folder}')
+        return snapshots[-1]
+    snapshot = load_tags(local_folder).get(snapshot, snapshot)
+    if not os.path.exists(manifest_file(local_folder, snapshot)):
+        raise ValueError(f'unknown snapshot or tag {snapshot!r} in {local_folder}')
+    return snapshot
+
+
+def load_manifest(local_folder, snapshot):
+    with open(manifest_file(local_folder, resolve_snapshot(local_folder, snapshot)), 'r') as f:
+        return json.load(f)
+
+
+def create_snapshot(local_folder, tag = None, workers = None):
+    # Series whose file is unchanged since the previous snapshot reuse its
+    # chunk list without being read
+    local_folder = Path(local_folder)
+    with file_lock(snapshots_folder(local_folder) / '.lock'):
+        previous = {}
+        snapshots = list_snapshots(local_folder)
+        if snapshots:
+            previous = load_manifest(local_folder, snapshots[-1])['series']
+
+        series, changed = {}, []
+        for filename in sorted(local_folder.glob('*.pkl')):
+            stat = os.stat(filename)
+            entry = previous.get(filename.stem)
+            if entry is not None and (entry['size'], entry['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+                series[filename.stem] = entry
+            else:
+                changed.append(filename)
+
+        new_bytes = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for key, entry, written in executor.map(snapshot_series, changed, [local_folder] * len(changed)):
+                series[key] = entry
+                new_bytes += written
+
+        snapshot_id = dt.datetime.now(dt.UTC).strftime('%Y%m%dT%H%M%S%f')
+        manifest = dict(id=snapshot_id
+                        , created=dt.datetime.now(dt.UTC).isoformat()
+                        , series=series
+                        )
+        filename = manifest_file(local_folder, snapshot_id)
+        os.makedirs(filename.parent, exist_ok=True)
+        with open(filename, 'w') as f:
+            json.dump(manifest, f)
+        if tag is not None:
+            tag_snapshot(local_folder, snapshot_id, tag)
+
+    print(f'create_snapshot() {local_folder} {snapshot_id}: {len(series)} series, {len(changed)} re-chunked, '
+          f'{new_bytes / 1024**2:.2f} MB of new chunks (uncompressed)')
+    return snapshot_id
+
+
+def tag_snapshot(local_folder, snapshot, tag):
+    tags = load_tags(local_folder)
+    tags[tag] = resolve_snapshot(local_folder, snapshot)
+    save_tags(tags, local_folder)
+    print(f'tag_snapshot() {tag} -> {tags[tag]}')
+
+
+def load_series_as_of(symbol, granularity, snapshot, local_folder):
+    entry = load_manifest(local_folder, snapshot)['series'].get(f'{symbol}_{granularity}')
+    if entry is None:
+        raise KeyError(f'{symbol}_{granularity} is not in snapshot {snapshot!r}')
+    frames = [load_chunk(local_folder, digest) for digest in entry['chunks']]
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    df.attrs = entry['attrs']
+    return as_datetime(df)
+
+
+def delete_snapshot(local_folder, snapshot):
+    with file_lock(snapshots_folder(local_folder) / '.lock'):
+        snapshot_id = resolve_snapshot(local_folder, snapshot)
+        os.remove(manifest_file(local_folder, snapshot_id))
+        tags = load_tags(local_folder)
+        save_tags({k: v for k, v in tags.items() if v != snapshot_id}, local_folder)
+    print(f'delete_snapshot() {snapshot_id} deleted, run gc to free its chunks')
+
+
+def collect_garbage(local_folder):
+    with file_lock(snapshots_folder(local_folder) / '.lock'):
+        referenced = set()
+        for snapshot_id in list_snapshots(local_folder):
+            for entry in load_manifest(local_folder, snapshot_id)['series'].values():
+                referenced.update(entry['chunks'])
+        removed = freed = 0
+        for filename in (snapshots_folder(local_folder) / 'chunks').glob('*/*'):
+            if filename.name not in referenced:
+                freed += filename.stat().st_size
+                os.remove(filename)
+                removed += 1
+    print(f'collect_garbage() {local_folder}: {removed} chunks removed, {freed / 1024**2:.1f} MB freed')
+    return removed
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Deduplicated snapshots of a quote vault')
+    arg_parser.add_argument('command', choices=['snapshot', 'tag', 'list', 'delete', 'gc'])
+    arg_parser.add_argument('local_folder')
+    arg_parser.add_argument('snapshot', nargs='?', help='snapshot id or tag (tag, delete)')
+    arg_parser.add_argument('--tag', default=None)
+    arg_parser.add_argument('--workers', type=int, default=None)
+    args = arg_parser.parse_args()
+
+    if args.command == 'snapshot':
+        create_snapshot(args.local_folder, args.tag, args.workers)
+    elif args.command == 'tag':
+        tag_snapshot(args.local_folder, args.snapshot, args.tag)
+    elif args.command == 'list':
+        tags = load_tags(args.local_folder)
+        for snapshot_id in list_snapshots(args.local_folder):
+            names = [tag for tag, target in tags.items() if target == snapshot_id]
+            print(snapshot_id, ' '.join(names))
+    elif args.command == 'delete':
+        delete_snapshot(args.local_folder, args.snapshot)
+    else:
+        collect_garbage(args.local_folder)
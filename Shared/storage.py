@@ -0,0 +1,306 @@
+import os
+import io
+import gzip
+import time
+import pickle
+import shutil
+import threading
+import argparse
+import functools
+import pandas as pd
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from Shared.locks import series_lock
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+CODECS = ['zstd', 'lz4', 'gzip', 'none']
+
+DEFAULT_LEVELS = {  'zstd' : 3
+                  , 'lz4'  : 0
+                  , 'gzip' : 6
+                  , 'none' : None
+                  }
+
+MAGIC = {  b'\x28\xb5\x2f\xfd' : 'zstd'
+         , b'\x04\x22\x4d\x18' : 'lz4'
+         , b'\x1f\x8b'         : 'gzip'
+         }
+
+# Per broker: granularity -> (codec, level), 'default' covers anything not listed
+COMPRESSION = {  'FxOpen' : {  'default' : ('zstd', 3)
+                             , 'M1'      : ('zstd', 9)
+                             }
+               , 'Oanda'  : {  'default' : ('zstd', 3)
+                             , 'M1'      : ('zstd', 9)
+                             }
+               }
+
+GENERATIONS_FOLDER = 'generations'
+GENERATIONS = 0     # previous versions kept per series on every write, 0 keeps none
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// CODECS /////////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def codec_available(codec):
+    if codec == 'zstd':
+        return zstandard is not None
+    if codec == 'lz4':
+        return lz4 is not None
+    return codec in CODECS
+
+
+@functools.lru_cache(maxsize=None)
+def warn_fallback(codec):
+    # Once per codec and process, codec_for runs on every save
+    print(f'codec_for() {codec} is not installed, falling back to gzip')
+
+
+def codec_for(broker, granularity, compression = COMPRESSION):
+    broker_compression = compression[broker]
+    codec, level = broker_compression.get(granularity, broker_compression['default'])
+    if not codec_available(codec):
+        warn_fallback(codec)
+        codec, level = 'gzip', DEFAULT_LEVELS['gzip']
+    return codec, level
+
+
+def compress(raw: bytes, codec, level = None):
+    level = DEFAULT_LEVELS[codec] if level is None else level
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(raw)
+    if codec == 'lz4':
+        return lz4.frame.compress(raw, compression_level=level)
+    if codec == 'gzip':
+        return gzip.compress(raw, compresslevel=level, mtime=0)
+    if codec == 'none':
+        return raw
+    raise ValueError(f'codec must be one of {CODECS}, got {codec!r}')
+
+
+def detect_codec(raw: bytes):
+    for magic, codec in MAGIC.items():
+        if raw[:len(magic)] == magic:
+            return codec
+    return 'none'
+
+
+def decompress(raw: bytes):
+    codec = detect_codec(raw)
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(raw)
+    if codec == 'lz4':
+        return lz4.frame.decompress(raw)
+    if codec == 'gzip':
+        return gzip.decompress(raw)
+    return raw
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// SERIES FILES ///////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def dumps_series(df: pd.DataFrame, codec = 'zstd', level = None):
+    return compress(pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL), codec, level)
+
+
+def loads_series(raw: bytes):
+    return pd.read_pickle(io.BytesIO(decompress(raw)))
+
+
+def write_series(df: pd.DataFrame, filename, codec = 'zstd', level = None, generations = None):
+    # Write then rename: readers see the old file or the new one, never a
+    # partial write, and handles opened before the rename keep the old data
+    generations = GENERATIONS if generations is None else generations
+    tmp_filename = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_filename, 'wb') as f:
+            f.write(dumps_series(df, codec, level))
+            f.flush()
+            os.fsync(f.fileno())
+        if generations > 0:
+            keep_generation(filename, generations)
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def read_series(filename):
+    with open(filename, 'rb') as f:
+        return loads_series(f.read())
+
+
+def file_codec(filename):
+    with open(filename, 'rb') as f:
+        return detect_codec(f.read(4))
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// GENERATIONS ////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def generations_folder(filename):
+    filename = Path(filename)
+    return filename.parent / GENERATIONS_FOLDER / filename.stem
+
+
+def keep_generation(filename, generations):
+    # Hard links the current version before it is replaced, so keeping a
+    # generation costs no copy on filesystems that support links
+    if not os.path.exists(filename):
+        return
+    folder = generations_folder(filename)
+    os.makedirs(folder, exist_ok=True)
+    target = folder / f'{os.stat(filename).st_mtime_ns}.pkl'
+    if not os.path.exists(target):
+        try:
+            os.link(filename, target)
+        except OSError:
+            shutil.copy2(filename, target)
+    for old in list_generations(filename)[:-generations]:
+        os.remove(old)
+
+
+def list_generations(filename):
+    # Oldest first, named by the mtime of the version they hold
+    return sorted(generations_folder(filename).glob('*.pkl'), key=lambda f: int(f.stem))
+
+
+def read_generation(filename, generation = -1):
+    return read_series(list_generations(filename)[generation])
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// MIGRATION //////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def recompress_file(filename, codec, level = None, force = False):
+    current = file_codec(filename)
+    if current == codec and not force:
+        return filename, current, None
+    size_before = os.path.getsize(filename)
+    with series_lock(filename):
+        write_series(read_series(filename), filename, codec, level, generations=0)
+    return filename, current, (size_before, os.path.getsize(filename))
+
+
+def recompress_vault(local_folder
+                     , broker
+                     , compression = COMPRESSION
+                     , workers = None
+                     , force = False
+                     ):
+    files = sorted(Path(local_folder).glob('*.pkl'))
+    settings = [codec_for(broker, f.stem.rsplit('_', 1)[-1], compression) for f in files]
+
+    before = after = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(recompress_file
+                               , files
+                               , [codec for codec, _ in settings]
+                               , [level for _, level in settings]
+                               , [force] * len(files)
+                               )
+        for (filename, current, sizes), (codec, level) in zip(results, settings):
+            if sizes is None:
+                print(f'recompress_vault() {filename.stem} already {codec}')
+                continue
+            before += sizes[0]
+            after += sizes[1]
+            print(f'recompress_vault() {filename.stem} {current} -> {codec}:{level}   >> '
+                  f'{sizes[0] / 1024**2:.1f} MB -> {sizes[1] / 1024**2:.1f} MB')
+    print(f'recompress_vault() {local_folder}: {before / 1024**2:.1f} MB -> {after / 1024**2:.1f} MB')
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// BENCHMARK //////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+BENCHMARK_SETTINGS = [  ('none', None)
+                      , ('lz4' , 0)
+                      , ('zstd', 1)
+                      , ('zstd', 3)
+                      , ('zstd', 9)
+                      , ('zstd', 19)
+                      , ('gzip', 1)
+                      , ('gzip', 6)
+                      ]
+
+
+def benchmark_codecs(local_folder
+                     , granularity = None
+                     , sample = 20
+                     , settings = BENCHMARK_SETTINGS
+                     ):
+    pattern = '*.pkl' if granularity is None else f'*_{granularity}.pkl'
+    files = sorted(Path(local_folder).glob(pattern))[:sample]
+    frames = [read_series(f) for f in files]
+    raw_bytes = sum(len(pickle.dumps(df, protocol=pickle.HIGHEST_PROTOCOL)) for df in frames)
+    if raw_bytes == 0:
+        print(f'benchmark_codecs() no series found in {local_folder}')
+        return None
+
+    rows = []
+    for codec, level in settings:
+        if not codec_available(codec):
+            print(f'benchmark_codecs() skipping {codec}, not installed')
+            continue
+        start = time.perf_counter()
+        blobs = [dumps_series(df, codec, level) for df in frames]
+        write_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for blob in blobs:
+            loads_series(blob)
+        read_s = time.perf_counter() - start
+
+        stored = sum(len(blob) for blob in blobs)
+        rows.append(dict(codec=codec
+                         , level=level
+                         , ratio=raw_bytes / stored
+                         , stored_mb=stored / 1024**2
+                         , write_mb_s=raw_bytes / 1024**2 / write_s
+                         , read_mb_s=raw_bytes / 1024**2 / read_s
+                         ))
+
+    report = pd.DataFrame(rows)
+    report['level'] = report['level'].astype('Int64')
+    print(f'benchmark_codecs() {len(files)} series, {raw_bytes / 1024**2:.1f} MB uncompressed')
+    print(report.to_string(index=False, float_format='%.2f'))
+    return report
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Recompress or benchmark a quote vault')
+    arg_parser.add_argument('command', choices=['migrate', 'benchmark'])
+    arg_parser.add_argument('local_folder')
+    arg_parser.add_argument('--broker', default=None, help='defaults to the Broker_* folder name')
+    arg_parser.add_argument('--codec', choices=CODECS, default=None, help='overrides COMPRESSION')
+    arg_parser.add_argument('--level', type=int, default=None)
+    arg_parser.add_argument('--granularity', default=None)
+    arg_parser.add_argument('--sample', type=int, default=20)
+    arg_parser.add_argument('--workers', type=int, default=None)
+    arg_parser.add_argument('--force', action='store_true')
+    args = arg_parser.parse_args()
+
+    if args.command == 'migrate':
+        broker = args.broker or Path(args.local_folder).resolve().parent.name.replace('Broker_', '')
+        compression = COMPRESSION
+        if args.codec is not None:
+            compression = {broker: {'default': (args.codec, args.level)}}
+        recompress_vault(args.local_folder, broker, compression, args.workers, args.force)
+    else:
+        benchmark_codecs(args.local_folder, args.granularity, args.sample)
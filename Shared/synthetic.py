@@ -0,0 +1,359 @@
+import os
+import json
+import time
+import zlib
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from Shared.adapters import ADAPTERS
+from Shared.storage import read_series, write_series, codec_for
+from Shared.validation import GRANULARITY_SECONDS
+from Shared.index import series_entry, load_index, save_index, index_lock, INDEX_LOCK
+from Shared.revisions import record_digests
+
+
+# Synthetic vaults in the exact stored schemas of both brokers, for scale
+# benchmarks and regression runs without broker data. Series are
+# deterministic per (seed, symbol), so the same command rebuilds the same vault.
+
+DAY_MS = 86_400_000
+MINUTE_MS = 60_000
+
+OHLC = ['o', 'h', 'l', 'c']
+
+# Session hours are UTC and ignore DST
+PROFILES = {  'Forex'     : dict(price=1.10 , daily_vol=0.006, spread_bps=0.8, precision=5, session='forex' , volume=120)
+            , 'Crypto'    : dict(price=30000, daily_vol=0.035, spread_bps=4.0, precision=2, session='crypto', volume=40)
+            , 'US Stocks' : dict(price=150  , daily_vol=0.018, spread_bps=2.0, precision=2, session='stocks', volume=800)
+            , 'CFD 00-01' : dict(price=4500 , daily_vol=0.011, spread_bps=1.5, precision=2, session='cfd'   , volume=300)
+            }
+
+SYMBOL_PREFIX = {  'Forex'     : 'FX'
+                 , 'Crypto'    : 'CR'
+                 , 'US Stocks' : 'ST'
+                 , 'CFD 00-01' : 'CF'
+                 }
+
+DEFAULT_GROUPS = ['Forex', 'Crypto', 'US Stocks']
+
+GAP_SIGMAS = 3      # cap, in bar sigmas, of the move over a session gap
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// SESSIONS ///////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def in_session(time_ms, session):
+    weekday = (time_ms // DAY_MS + 3) % 7           # 0 Monday, 1970-01-01 was a Thursday
+    minute = (time_ms % DAY_MS) // MINUTE_MS
+    if session == 'crypto':
+        return np.ones(time_ms.shape, dtype=bool)
+    if session == 'stocks':
+        return (weekday < 5) & (minute >= 14 * 60 + 30) & (minute < 21 * 60)
+    # Forex and CFDs close from Friday 22:00 to Sunday 22:00, CFDs also
+    # pause for an hour every day
+    open_ = ~((weekday == 5) | ((weekday == 4) & (minute >= 22 * 60)) | ((weekday == 6) & (minute < 22 * 60)))
+    if session == 'cfd':
+        open_ &= ~((minute >= 21 * 60) & (minute < 22 * 60))
+    return open_
+
+
+def session_bars(start_ms, end_ms, step_ms, session):
+    # Bar open times on the granularity grid with any traded minute inside the
+    # bar, sampled at up to 60 points per bar
+    first = -(-start_ms // step_ms) * step_ms
+    times = np.arange(first, end_ms, step_ms, dtype='int64')
+    samples = min(step_ms // MINUTE_MS, 60)
+    offsets = (np.arange(samples, dtype='int64') * (step_ms // samples)) // MINUTE_MS * MINUTE_MS
+    mask = np.zeros(len(times), dtype=bool)
+    for offset in offsets:
+        mask |= in_session(times + offset, session)
+    return times[mask]
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// PRICES /////////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def symbol_seed(seed, symbol):
+    return zlib.crc32(f'{seed}/{symbol}'.encode())
+
+
+def random_walk(times, step_ms, profile, rng):
+    # Mid OHLC from a log random walk, bar sigma scaled from the daily
+    # volatility. Moves over session gaps grow with the gap up to GAP_SIGMAS.
+    n = len(times)
+    sigma = profile['daily_vol'] * np.sqrt(step_ms / DAY_MS)
+    gaps = np.ones(n)
+    gaps[1:] = np.diff(times) / step_ms
+    scale = np.minimum(np.sqrt(gaps), GAP_SIGMAS)
+    returns = rng.standard_normal(n) * sigma * scale
+    price = profile['price'] * rng.uniform(0.5, 1.5)
+    close = price * np.exp(np.cumsum(returns))
+    open_ = np.concatenate([[price], close[:-1]])
+    wick = np.abs(rng.standard_normal((2, n))) * sigma * 0.5
+    high = np.maximum(open_, close) * np.exp(wick[0])
+    low = np.minimum(open_, close) * np.exp(-wick[1])
+    return dict(o=open_, h=high, l=low, c=close), gaps
+
+
+def spreads(times, mid_close, gaps, profile, rng):
+    # Lognormal around spread_bps, wider on the first bar after a gap and
+    # over the FX rollover, at least one tick
+    spread = mid_close * profile['spread_bps'] * 1e-4 * np.exp(0.25 * rng.standard_normal(len(times)))
+    spread[gaps > 1] *= 3
+    if profile['session'] == 'forex':
+        minute = (times % DAY_MS) // MINUTE_MS
+        spread[(minute >= 21 * 60) & (minute < 23 * 60)] *= 2
+    return np.maximum(spread, 10.0 ** -profile['precision'])
+
+
+def base_frame(times, step_ms, profile, rng):
+    mid, gaps = random_walk(times, step_ms, profile, rng)
+    spread = spreads(times, mid['c'], gaps, profile, rng)
+    precision = profile['precision']
+    data = {'time': times}
+    # One spread per bar keeps bid and ask OHLC consistent after rounding
+    for x in OHLC:
+        data[f'bid_{x}'] = np.round(mid[x] - spread / 2, precision)
+        data[f'ask_{x}'] = np.round(mid[x] + spread / 2, precision)
+    data['volume'] = rng.poisson(profile['volume'] * step_ms / MINUTE_MS, len(times)).astype('int64') + 1
+    return pd.DataFrame(data)
+
+
+def aggregate(df, step_ms):
+    # Coarser bars from the base bars, so every granularity of a symbol tells
+    # the same story
+    keys = df['time'].to_numpy() // step_ms
+    starts = np.r_[0, np.flatnonzero(np.diff(keys)) + 1]
+    ends = np.r_[starts[1:], len(df)] - 1
+    out = {'time': keys[starts] * step_ms}
+    for column in df.columns:
+        values = df[column].to_numpy()
+        if column.endswith('_o'):
+            out[column] = values[starts]
+        elif column.endswith('_h'):
+            out[column] = np.maximum.reduceat(values, starts)
+        elif column.endswith('_l'):
+            out[column] = np.minimum.reduceat(values, starts)
+        elif column.endswith('_c'):
+            out[column] = values[ends]
+        elif column == 'volume':
+            out[column] = np.add.reduceat(values, starts)
+    return pd.DataFrame(out)
+
+
+def broker_schema(df, broker):
+    # Column order and dtypes as complete_price_columns leaves them in
+    # Broker_*/api.py, with int64 epoch ms time as save_to_file stores it
+    for x in OHLC:
+        df[f'mid_{x}'] = (df[f'ask_{x}'] + df[f'bid_{x}']) / 2
+    labels = ['bid', 'ask', 'mid'] if broker == 'FxOpen' else ['mid', 'bid', 'ask']
+    columns = [f'{label}_{x}' for label in labels for x in OHLC]
+    if broker == 'FxOpen':
+        df = df[['time', *columns]].copy()
+    else:
+        df = df[['time', 'volume', *columns]].copy()
+    # Both engines request bid and ask, mid is derived from them
+    df.attrs['price_components'] = 'BA'
+    return df
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// VAULT //////////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def synthetic_symbols(broker, count, groups = DEFAULT_GROUPS):
+    symbols = {}
+    for n in range(count):
+        group = groups[n % len(groups)]
+        separator = '_' if broker == 'Oanda' else ''
+        symbols[f'{SYMBOL_PREFIX[group]}{separator}{n:05d}'] = group
+    return symbols
+
+
+def generate_series(broker, symbol, group, granularity_lst, start_ms, end_ms, local_folder, seed = 0):
+    profile = PROFILES[group]
+    rng = np.random.default_rng(symbol_seed(seed, symbol))
+    steps = sorted((GRANULARITY_SECONDS[g] * 1000, g) for g in granularity_lst)
+    base_step = steps[0][0]
+    times = session_bars(start_ms, end_ms, base_step, profile['session'])
+    base = base_frame(times, base_step, profile, rng)
+
+    entries = {}
+    for step_ms, granularity in steps:
+        df = broker_schema(base if step_ms == base_step else aggregate(base, step_ms), broker)
+        filename = Path(local_folder) / f'{symbol}_{granularity}.pkl'
+        write_series(df, filename, *codec_for(broker, granularity), generations=0)
+        record_digests(df, filename, local_folder)
+        entries[filename.stem] = series_entry(df, filename)
+    return entries
+
+
+def write_catalog(broker, symbols, local_folder):
+    # FxOpen keeps its instrument catalog next to the vault, the CLI, planner
+    # and SQL layer read StatusGroupId from it
+    if broker != 'FxOpen':
+        return
+    filename = Path(local_folder) / 'refs' / 'tradables_dict.json'
+    os.makedirs(filename.parent, exist_ok=True)
+    catalog = {symbol: dict(Symbol=symbol
+                            , Description=f'Synthetic {group}'
+                            , StatusGroupId=group
+                            , Precision=PROFILES[group]['precision']
+                            )
+               for symbol, group in symbols.items()}
+    with open(filename, 'w') as f:
+        json.dump(catalog, f, indent=4)
+
+
+def estimate_rows(start_ms, end_ms, granularity, group):
+    from Shared.planner import SESSION_SHARE, DEFAULT_SESSION_SHARE
+    bars = (end_ms - start_ms) / (GRANULARITY_SECONDS[granularity] * 1000)
+    return bars * SESSION_SHARE.get(group, DEFAULT_SESSION_SHARE)
+
+
+def generate_vault(broker
+                   , local_folder
+                   , symbol_count
+                   , granularity_lst
+                   , date_start
+                   , date_end
+                   , groups = DEFAULT_GROUPS
+                   , seed = 0
+                   , workers = None
+                   ):
+    adapter = ADAPTERS[broker]
+    unsupported = [g for g in granularity_lst if g not in adapter.granularities]
+    if unsupported:
+        raise ValueError(f'{broker} granularities are {adapter.granularities}, got {unsupported}')
+    if Path(local_folder).resolve() == Path(adapter.local_folder).resolve():
+        raise ValueError(f'refusing to write synthetic series into the {broker} vault {local_folder}')
+
+    start_ms = int(pd.Timestamp(date_start).value // 1_000_000)
+    end_ms = int(pd.Timestamp(date_end).value // 1_000_000)
+    symbols = synthetic_symbols(broker, symbol_count, groups)
+    columns = 13 if broker == 'FxOpen' else 14
+    est_rows = sum(estimate_rows(start_ms, end_ms, g, group) for group in symbols.values() for g in granularity_lst)
+    print(f'generate_vault() {broker} {len(symbols)} symbols x {granularity_lst} >> '
+          f'~{est_rows / 1e6:,.0f}M rows, ~{est_rows * columns * 8 / 1024**3:,.1f} GB uncompressed')
+
+    os.makedirs(local_folder, exist_ok=True)
+    write_catalog(broker, symbols, local_folder)
+    start = time.perf_counter()
+    entries = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(generate_series, broker, symbol, group, granularity_lst
+                                   , start_ms, end_ms, local_folder, seed)
+                   for symbol, group in symbols.items()]
+        for n, future in enumerate(futures, 1):
+            entries.update(future.result())
+            if n % 100 == 0 or n == len(futures):
+                print(f'generate_vault() {n} of {len(futures)} symbols written')
+
+    # One index write for the whole run instead of one per series
+    with INDEX_LOCK, index_lock(local_folder):
+        index = load_index(local_folder)
+        index.update(entries)
+        save_index(index, local_folder)
+
+    rows = sum(entry['rows'] for entry in entries.values())
+    size = sum(entry['size'] for entry in entries.values())
+    print(f'generate_vault() {local_folder}: {len(entries)} series, {rows:,} rows, '
+          f'{size / 1024**2:,.1f} MB on disk in {time.perf_counter() - start:.1f}s')
+    return entries
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// SCALE BENCHMARK ////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def timed(rows, name, func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    rows.append(dict(stage=name, seconds=seconds))
+    return result, seconds
+
+
+def bench_vault(local_folder, broker, granularity, sample = 20, workers = None):
+    # Load, panel, coverage, validation, SQL and export timings on a vault,
+    # meant for one written by generate_vault
+    from Shared.index import coverage, refresh_index
+    from Shared.panel import load_panel
+    from Shared.validation import sweep_vault
+    from Shared.query import VaultSQL
+
+    local_folder = Path(local_folder)
+    files = sorted(local_folder.glob(f'*_{granularity}.pkl'))
+    if len(files) == 0:
+        print(f'bench_vault() no {granularity} series in {local_folder}')
+        return None
+    picked = files[:sample]
+    symbols = [f.stem.rsplit('_', 1)[0] for f in picked]
+    rows = []
+
+    frames, seconds = timed(rows, f'load {len(picked)} series', lambda: [read_series(f) for f in picked])
+    n_rows = sum(len(df) for df in frames)
+    rows[-1].update(rows=n_rows, rows_s=n_rows / seconds)
+
+    timed(rows, f'panel {len(symbols)} symbols', load_panel, symbols, granularity, local_folder, workers=workers)
+    rows[-1].update(rows=n_rows, rows_s=n_rows / rows[-1]['seconds'])
+
+    n_series = len(list(local_folder.glob('*.pkl')))
+    timed(rows, f'coverage {n_series} series', coverage, local_folder)
+    timed(rows, f'index rebuild {n_series} series', refresh_index, local_folder, True)
+
+    export_folder = Path(tempfile.mkdtemp())
+    try:
+        timed(rows, f'export csv {len(picked)} series'
+              , lambda: [df.to_csv(export_folder / f'{f.stem}.csv', index=False) for f, df in zip(picked, frames)])
+        rows[-1].update(rows=n_rows, rows_s=n_rows / rows[-1]['seconds'])
+    finally:
+        shutil.rmtree(export_folder)
+
+    timed(rows, f'validate {n_series} series', sweep_vault, local_folder, workers, quarantine=False
+          , print_to_console=False)
+    timed(rows, f'validate {n_series} series (cached)', sweep_vault, local_folder, workers, quarantine=False
+          , print_to_console=False)
+
+    vault_sql = VaultSQL({broker: local_folder})
+    timed(rows, f'sql sync {n_series} series', vault_sql.sync, None, workers)
+    sql = ('SELECT symbol, count(*) AS bars, avg(ask_c - bid_c) AS spread FROM quotes '
+           'WHERE symbol IN ({}) GROUP BY symbol').format(', '.join('?' * len(symbols)))
+    timed(rows, f'sql query {len(symbols)} symbols', vault_sql.query, sql, symbols, None, [granularity])
+    timed(rows, f'sql query {len(symbols)} symbols (cached)', vault_sql.query, sql, symbols, None, [granularity])
+
+    report = pd.DataFrame(rows)
+    report['rows'] = report['rows'].astype('Int64')
+    print(f'bench_vault() {local_folder} {broker} {granularity}')
+    print(report.to_string(index=False, float_format='%.3f', na_rep='-'))
+    return report
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Write or benchmark a synthetic quote vault')
+    arg_parser.add_argument('command', choices=['generate', 'bench'])
+    arg_parser.add_argument('broker', choices=list(ADAPTERS))
+    arg_parser.add_argument('local_folder')
+    arg_parser.add_argument('--symbols', type=int, default=100, help='symbols to generate')
+    arg_parser.add_argument('--groups', nargs='+', choices=list(PROFILES), default=DEFAULT_GROUPS)
+    arg_parser.add_argument('--granularities', nargs='+', default=['M1', 'H1'])
+    arg_parser.add_argument('--start', default='2023-01-01')
+    arg_parser.add_argument('--end', default='2025-01-01')
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--sample', type=int, default=20, help='series loaded, exported and queried (bench)')
+    arg_parser.add_argument('--workers', type=int, default=None)
+    args = arg_parser.parse_args()
+
+    if args.command == 'generate':
+        generate_vault(args.broker, args.local_folder, args.symbols, args.granularities, args.start, args.end
+                       , args.groups, args.seed, args.workers)
+    else:
+        for granularity in args.granularities:
+            bench_vault(args.local_folder, args.broker, granularity, args.sample, args.workers)
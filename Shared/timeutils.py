@@ -0,0 +1,139 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from Shared.storage import read_series, write_series, file_codec
+from Shared.locks import series_lock
+
+
+# Canonical stored time: int64 milliseconds since the Unix epoch, UTC.
+# Both brokers write it, readers convert to naive UTC datetime64[ms] on demand.
+TIME_DTYPE = 'int64'
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// CONVERSIONS ////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def epoch_ms(time):
+    if isinstance(time, (pd.Series, pd.Index)):
+        if isinstance(time.dtype, pd.DatetimeTZDtype):
+            time = time.dt.tz_convert(None) if isinstance(time, pd.Series) else time.tz_convert(None)
+        values = time.to_numpy()
+    else:
+        values = np.asarray(time)
+    if np.issubdtype(values.dtype, np.integer):
+        return values.astype(TIME_DTYPE, copy=False)
+    return values.astype('datetime64[ms]').view(TIME_DTYPE)
+
+
+def time_as_ns(df):
+    return epoch_ms(df['time']) * 1_000_000
+
+
+def from_epoch_ms(values):
+    return np.asarray(values, dtype=TIME_DTYPE).view('datetime64[ms]')
+
+
+def as_epoch_ms(df):
+    if df['time'].dtype == TIME_DTYPE:
+        return df
+    return df.assign(time=epoch_ms(df['time']))
+
+
+def as_datetime(df):
+    if df['time'].dtype != TIME_DTYPE:
+        return df
+    return df.assign(time=from_epoch_ms(df['time']))
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// VAULT MIGRATION ////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def migrate_file(filename):
+    with series_lock(filename):
+        df = read_series(filename)
+        if df['time'].dtype == TIME_DTYPE:
+            return False
+        write_series(as_epoch_ms(df), filename, file_codec(filename), generations=0)
+    return True
+
+
+def migrate_vault(local_folder, workers = None):
+    files = sorted(Path(local_folder).glob('*.pkl'))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        migrated = list(executor.map(migrate_file, files))
+    print(f'migrate_vault() {local_folder}: {sum(migrated)} of {len(files)} series '
+          f'converted to int64 epoch ms')
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// CROSS BROKER ALIGNMENT /////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+# FxOpen granularity -> Oanda granularity, anything not listed is the same
+GRANULARITY_MAP = {'D1': 'D'}
+
+
+def default_symbol_map(fx_symbols, oanda_symbols):
+    oanda_by_key = {s.replace('_', ''): s for s in oanda_symbols}
+    return {s: oanda_by_key[s] for s in fx_symbols if s in oanda_by_key}
+
+
+def align_pair(left, right, price_field = 'c', names = ('left', 'right')):
+    t_left, t_right = epoch_ms(left['time']), epoch_ms(right['time'])
+    times, i_left, i_right = np.intersect1d(t_left, t_right, assume_unique=True, return_indices=True)
+
+    def side(df, idx, label):
+        return df[f'{label}_{price_field}'].to_numpy(dtype='float64')[idx]
+
+    aligned = pd.DataFrame({'time': times})
+    for name, df, idx in [(names[0], left, i_left), (names[1], right, i_right)]:
+        aligned[f'{name}_mid'] = side(df, idx, 'mid')
+        aligned[f'{name}_spread'] = side(df, idx, 'ask') - side(df, idx, 'bid')
+    aligned['mid_diff'] = aligned[f'{names[0]}_mid'] - aligned[f'{names[1]}_mid']
+    aligned['mid_diff_bps'] = aligned['mid_diff'] / aligned[f'{names[1]}_mid'] * 1e4
+    aligned['spread_diff'] = aligned[f'{names[0]}_spread'] - aligned[f'{names[1]}_spread']
+    return aligned
+
+
+def compare_brokers(symbol_map
+                    , granularity
+                    , fx_folder
+                    , oanda_folder
+                    , price_field = 'c'
+                    ):
+    oanda_granularity = GRANULARITY_MAP.get(granularity, granularity)
+    aligned, summary = {}, []
+    for fx_symbol, oanda_symbol in symbol_map.items():
+        fx_file = Path(fx_folder) / f'{fx_symbol}_{granularity}.pkl'
+        oanda_file = Path(oanda_folder) / f'{oanda_symbol}_{oanda_granularity}.pkl'
+        if not (os.path.exists(fx_file) and os.path.exists(oanda_file)):
+            print(f'compare_brokers() skipping {fx_symbol}/{oanda_symbol} --> missing series')
+            continue
+        df = align_pair(read_series(fx_file), read_series(oanda_file), price_field, ('fxopen', 'oanda'))
+        aligned[fx_symbol] = df
+        summary.append(dict(symbol=fx_symbol
+                            , oanda_symbol=oanda_symbol
+                            , rows=len(df)
+                            , mean_mid_diff_bps=df['mid_diff_bps'].mean()
+                            , abs_mid_diff_bps_p99=df['mid_diff_bps'].abs().quantile(0.99)
+                            , fxopen_mean_spread=df['fxopen_spread'].mean()
+                            , oanda_mean_spread=df['oanda_spread'].mean()
+                            , mean_spread_diff=df['spread_diff'].mean()
+                            ))
+    return aligned, pd.DataFrame(summary)
+
+
+if __name__ == '__main__':
+
+    arg_parser = argparse.ArgumentParser(description='Convert stored time to int64 epoch ms')
+    arg_parser.add_argument('local_folder', nargs='+')
+    arg_parser.add_argument('--workers', type=int, default=None)
+    args = arg_parser.parse_args()
+
+    for local_folder in args.local_folder:
+        migrate_vault(local_folder, args.workers)
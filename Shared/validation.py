@@ -0,0 +1,308 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from Shared.storage import loads_series
+from Shared.timeutils import time_as_ns
+from Shared.index import remove_from_index
+from Shared.locks import file_lock, series_lock, LockBusy
+
+
+VALIDATION_VERSION = 1
+
+QUARANTINE_FOLDER = 'quarantine'
+REPORTS_FOLDER    = 'reports'
+CACHE_FILE        = 'refs/validation_cache.json'
+
+GRANULARITY_SECONDS = {  'M1' : 60
+                       , 'M5' : 5    * 60
+                       , 'M15': 15   * 60
+                       , 'M30': 30   * 60
+                       , 'H1' : 60   * 60
+                       , 'H2' : 120  * 60
+                       , 'H4' : 240  * 60
+                       , 'D'  : 1440 * 60
+                       , 'D1' : 1440 * 60
+                       }
+
+PRICE_LABELS = {  'M' : 'mid'
+                , 'B' : 'bid'
+                , 'A' : 'ask'
+                }
+
+OHLC = ['o', 'h', 'l', 'c']
+
+# Max fraction of rows allowed to fail each check before the series fails
+TOLERANCE = {  'bad_price'         : 0.0
+             , 'ohlc_inconsistent' : 0.0
+             , 'inverted_spread'   : 0.0
+             , 'duplicate_time'    : 0.0
+             , 'unsorted_time'     : 0.0
+             , 'off_grid_time'     : 0.0
+             , 'spike'             : 0.001
+             }
+
+SPIKE_Z = 15        # robust z-score of close-to-close log returns
+SAMPLE_SIZE = 5     # offending timestamps kept per check in the report
+
+CACHE_LOCK = threading.Lock()
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// CHECKS /////////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def fetched_labels(df):
+    components = df.attrs.get('price_components')
+    if components is None:
+        labels = [l for l in PRICE_LABELS.values() if f'{l}_c' in df.columns]
+    else:
+        labels = [PRICE_LABELS[c] for c in components if c in PRICE_LABELS]
+        if 'bid' in labels and 'ask' in labels and 'mid' not in labels:
+            labels.append('mid')
+    return [l for l in labels if f'{l}_c' in df.columns]
+
+
+def check_prices(df, labels):
+    masks = {}
+    bad_price = np.zeros(len(df), dtype=bool)
+    inconsistent = np.zeros(len(df), dtype=bool)
+    for label in labels:
+        o, h, l, c = (df[f'{label}_{x}'].to_numpy(dtype='float64') for x in OHLC)
+        with np.errstate(invalid='ignore'):
+            bad_price |= ~((o > 0) & (h > 0) & (l > 0) & (c > 0))
+            inconsistent |= (h < l) | (h < np.maximum(o, c)) | (l > np.minimum(o, c))
+    masks['bad_price'] = bad_price
+    masks['ohlc_inconsistent'] = inconsistent & ~bad_price
+
+    inverted = np.zeros(len(df), dtype=bool)
+    if 'bid' in labels and 'ask' in labels:
+        for x in OHLC:
+            with np.errstate(invalid='ignore'):
+                inverted |= df[f'bid_{x}'].to_numpy(dtype='float64') > df[f'ask_{x}'].to_numpy(dtype='float64')
+    masks['inverted_spread'] = inverted
+    return masks
+
+
+def check_times(df, granularity):
+    masks = {}
+    t = time_as_ns(df)
+    step = GRANULARITY_SECONDS.get(granularity)
+
+    masks['duplicate_time'] = np.zeros(len(t), dtype=bool)
+    masks['unsorted_time'] = np.zeros(len(t), dtype=bool)
+    if len(t) > 1:
+        delta = np.diff(t)
+        masks['duplicate_time'][1:] = delta == 0
+        masks['unsorted_time'][1:] = delta < 0
+
+    if step is None:
+        masks['off_grid_time'] = np.zeros(len(t), dtype=bool)
+    else:
+        # H2 and above are aligned to the broker's trading day, which moves
+        # with DST, so only the whole hour is enforced for them
+        grid = min(step, 3600) * 10**9
+        masks['off_grid_time'] = (t % grid) != 0
+    return masks
+
+
+def check_spikes(df, labels):
+    spikes = np.zeros(len(df), dtype=bool)
+    if len(labels) == 0 or len(df) < 3:
+        return {'spike': spikes}
+
+    label = 'mid' if 'mid' in labels else labels[0]
+    close = df[f'{label}_c'].to_numpy(dtype='float64')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        returns = np.diff(np.log(close))
+    finite = np.isfinite(returns)
+    if finite.sum() < 3:
+        return {'spike': spikes}
+
+    median = np.median(returns[finite])
+    mad = np.median(np.abs(returns[finite] - median)) * 1.4826
+    if mad == 0:
+        return {'spike': spikes}
+    with np.errstate(invalid='ignore'):
+        spikes[1:] = np.abs(returns - median) / mad > SPIKE_Z
+    return {'spike': spikes}
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// VALIDATE ///////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def validate_candles(df: pd.DataFrame
+                     , granularity
+                     , tolerance = TOLERANCE
+                     ):
+    labels = fetched_labels(df)
+    masks = {}
+    masks.update(check_prices(df, labels))
+    masks.update(check_times(df, granularity))
+    masks.update(check_spikes(df, labels))
+
+    rows = len(df)
+    times = time_as_ns(df).view('datetime64[ns]')
+    checks = {}
+    passed = rows > 0
+    for name, mask in masks.items():
+        count = int(mask.sum())
+        sample = [str(t) for t in times[mask][:SAMPLE_SIZE]]
+        checks[name] = dict(count=count, sample=sample)
+        if count > tolerance.get(name, 0.0) * rows:
+            passed = False
+
+    report = dict(granularity=granularity
+                  , rows=rows
+                  , price_components=df.attrs.get('price_components')
+                  , time_from=str(times.min()) if rows > 0 else None
+                  , time_to=str(times.max()) if rows > 0 else None
+                  , checks=checks
+                  , passed=passed
+                  , version=VALIDATION_VERSION
+                  )
+    return report
+
+
+def validate_file(filename, tolerance = TOLERANCE):
+    with open(filename, 'rb') as f:
+        raw = f.read()
+    report = dict(content_hash=content_hash(raw, tolerance))
+    granularity = Path(filename).stem.rsplit('_', 1)[-1]
+    try:
+        df = loads_series(raw)
+        report.update(validate_candles(df, granularity, tolerance))
+    except Exception as error:
+        report.update(granularity=granularity, passed=False, error=str(error))
+    return report
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// REPORTS, QUARANTINE AND CACHE //////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def content_hash(raw: bytes, tolerance = TOLERANCE):
+    h = hashlib.blake2b(raw, digest_size=16)
+    h.update(json.dumps([VALIDATION_VERSION, SPIKE_Z, tolerance], sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def write_report(report, series_name, local_folder):
+    reports_folder = Path(local_folder) / REPORTS_FOLDER
+    os.makedirs(reports_folder, exist_ok=True)
+    with open(reports_folder / f'{series_name}.json', 'w') as f:
+        json.dump(report, f, indent=4)
+
+
+def quarantine_folder(local_folder):
+    return Path(local_folder) / QUARANTINE_FOLDER
+
+
+def quarantine_file(filename, local_folder, expected_hash = None, tolerance = TOLERANCE):
+    # Under the series lock, and only if the file still holds the content that
+    # failed validation: a download may be writing it or may have replaced it
+    # since. Returns None when the series is left in place.
+    from Shared.revisions import digests_file
+    try:
+        with series_lock(filename, blocking=False):
+            if expected_hash is not None:
+                with open(filename, 'rb') as f:
+                    if content_hash(f.read(), tolerance) != expected_hash:
+                        return None
+            folder = quarantine_folder(local_folder)
+            os.makedirs(folder, exist_ok=True)
+            target = folder / Path(filename).name
+            os.replace(filename, target)
+            remove_from_index(filename, local_folder)
+            digests = digests_file(local_folder, Path(filename).stem)
+            if os.path.exists(digests):
+                os.remove(digests)
+            return target
+    except (LockBusy, FileNotFoundError):
+        return None
+
+
+def load_cache(local_folder):
+    cache_file = Path(local_folder) / CACHE_FILE
+    if not os.path.exists(cache_file):
+        return {}
+    with open(cache_file, 'r') as f:
+        return json.load(f)
+
+
+def save_cache(cache, local_folder):
+    cache_file = Path(local_folder) / CACHE_FILE
+    os.makedirs(cache_file.parent, exist_ok=True)
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f, indent=4)
+    os.replace(tmp_file, cache_file)
+
+
+def remember_validation(filename, report, local_folder, tolerance = TOLERANCE):
+    with open(filename, 'rb') as f:
+        digest = content_hash(f.read(), tolerance)
+    with CACHE_LOCK, file_lock(f'{Path(local_folder) / CACHE_FILE}.lock'):
+        cache = load_cache(local_folder)
+        cache[Path(filename).name] = dict(content_hash=digest, passed=report['passed'])
+        save_cache(cache, local_folder)
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// VAULT SWEEP ////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def sweep_vault(local_folder
+                , workers = None
+                , tolerance = TOLERANCE
+                , quarantine = True
+                , print_to_console = True
+                ):
+    local_folder = Path(local_folder)
+    cache = load_cache(local_folder)
+    files = sorted(local_folder.glob('*.pkl'))
+
+    pending = []
+    for filename in files:
+        entry = cache.get(filename.name)
+        if entry is not None and entry['passed']:
+            with open(filename, 'rb') as f:
+                if content_hash(f.read(), tolerance) == entry['content_hash']:
+                    continue
+        pending.append(filename)
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        reports = executor.map(validate_file, pending, [tolerance] * len(pending))
+        for filename, report in zip(pending, reports):
+            write_report(report, filename.stem, local_folder)
+            results[filename.name] = report['passed']
+            if report['passed']:
+                cache[filename.name] = dict(content_hash=report['content_hash'], passed=True)
+            else:
+                cache.pop(filename.name, None)
+                if quarantine and quarantine_file(filename, local_folder, report['content_hash'], tolerance) is None:
+                    print(f'sweep_vault() {filename.stem} changed or locked by a download --> NOT QUARANTINED')
+            if print_to_console:
+                status = 'OK' if report['passed'] else 'FAILED'
+                print(f'sweep_vault() {filename.stem} --> {status}')
+
+    save_cache(cache, local_folder)
+    print(f'sweep_vault() {local_folder}: {len(files)} series, '
+          f'{len(files) - len(pending)} cached, {len(pending)} validated, '
+          f'{sum(not ok for ok in results.values())} failed')
+    return results
+
+
+if __name__ == '__main__':
+
+    ROOT = Path(__file__).parent.parent
+    for broker_folder in ['Broker_FxOpen', 'Broker_Oanda']:
+        vault = ROOT / broker_folder / 'hist_quotes'
+        if os.path.exists(vault):
+            sweep_vault(vault)
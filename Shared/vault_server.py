@@ -0,0 +1,256 @@
+import os
+import sys
+import signal
+import threading
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from collections import OrderedDict, deque
+from multiprocessing.managers import BaseManager
+from multiprocessing.shared_memory import SharedMemory
+from Shared.storage import read_series
+from Shared.timeutils import time_as_ns
+
+
+ROOT = Path(__file__).parent.parent
+
+VAULT_FOLDERS = {  'FxOpen' : ROOT / 'Broker_FxOpen' / 'hist_quotes'
+                 , 'Oanda'  : ROOT / 'Broker_Oanda' / 'hist_quotes'
+                 }
+
+VAULT_ADDRESS = ('127.0.0.1', 50717)
+VAULT_AUTHKEY = b'price-tape-vault'
+MEMORY_BUDGET = 8 * 1024**3     # bytes of shared memory the server may hold
+EVICTION_LOG = 4096             # evicted block names kept for clients to catch up on
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// SHARED MEMORY LAYOUT ///////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+# Each series lives in one block: [int64 time (rows) | float64 fields x rows].
+# Fields are stored column-major so a client can wrap the block in a
+# DataFrame without copying and every column is a contiguous slice.
+
+def block_views(buf, rows, n_fields):
+    times = np.ndarray((rows,), dtype='int64', buffer=buf)
+    values = np.ndarray((n_fields, rows), dtype='float64', buffer=buf, offset=rows * 8)
+    return times, values
+
+
+def naive_utc(date):
+    ts = pd.Timestamp(date)
+    return ts if ts.tz is None else ts.tz_convert('UTC').tz_localize(None)
+
+
+def series_key(broker, symbol, granularity):
+    return f'{broker}/{symbol}_{granularity}'
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// SERVER /////////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+class VaultStore:
+
+    def __init__(self, vault_folders=VAULT_FOLDERS, memory_budget=MEMORY_BUDGET):
+        self.vault_folders = {k: Path(v) for k, v in vault_folders.items()}
+        self.memory_budget = memory_budget
+        self.loaded = OrderedDict()     # key -> entry, least recently used first
+        self.used_bytes = 0
+        self.generation = 0             # eviction counter
+        self.evicted = deque(maxlen=EVICTION_LOG)   # (generation, block name)
+        self.lock = threading.Lock()
+
+    def list_series(self, broker=None):
+        series = []
+        for name, folder in self.vault_folders.items():
+            if broker is not None and name != broker:
+                continue
+            for filename in sorted(folder.glob('*.pkl')):
+                symbol, granularity = filename.stem.rsplit('_', 1)
+                series.append((name, symbol, granularity))
+        return series
+
+    def evicted_since(self, generation):
+        # Block names evicted after generation, None when the log no longer
+        # reaches back that far and the client has to drop all its blocks
+        if generation == self.generation:
+            return []
+        if len(self.evicted) == 0 or self.evicted[0][0] > generation + 1:
+            return None
+        return [name for g, name in self.evicted if g > generation]
+
+    def acquire(self, broker, symbol, granularity, generation=0):
+        # generation is the eviction generation the client last saw, the
+        # reply lists the blocks evicted since so the client can detach them
+        key = series_key(broker, symbol, granularity)
+        filename = self.vault_folders[broker] / f'{symbol}_{granularity}.pkl'
+        with self.lock:
+            mtime = os.stat(filename).st_mtime_ns
+            entry = self.loaded.get(key)
+            if entry is not None and entry['mtime'] != mtime:
+                print(f'VaultStore {key} was rewritten --> reloading')
+                self.evict(key)
+                entry = None
+            if entry is None:
+                entry = self.load(key, filename, mtime)
+            self.loaded.move_to_end(key)
+            entry['hits'] += 1
+            desc = {k: entry[k] for k in ['name', 'rows', 'fields', 'mtime']}
+            desc['evicted'] = self.evicted_since(generation)
+            desc['generation'] = self.generation
+            return desc
+
+    def load(self, key, filename, mtime):
+        df = read_series(filename)
+        t = time_as_ns(df)
+        fields = [c for c in df.columns if c != 'time' and pd.api.types.is_numeric_dtype(df[c])]
+        nbytes = max(len(t) * 8 * (1 + len(fields)), 1)
+
+        while self.loaded and self.used_bytes + nbytes > self.memory_budget:
+            self.evict(next(iter(self.loaded)))
+        if nbytes > self.memory_budget:
+            print(f'VaultStore {key} ({nbytes} bytes) exceeds the memory budget on its own')
+
+        shm = SharedMemory(create=True, size=nbytes)
+        times, values = block_views(shm.buf, len(t), len(fields))
+        times[:] = t
+        values[:] = df[fields].to_numpy(dtype='float64').T
+        del times, values
+
+        entry = dict(shm=shm, name=shm.name, rows=len(t), fields=fields
+                     , mtime=mtime, nbytes=nbytes, hits=0)
+        self.loaded[key] = entry
+        self.used_bytes += nbytes
+        return entry
+
+    def evict(self, key):
+        entry = self.loaded.pop(key)
+        self.used_bytes -= entry['nbytes']
+        self.generation += 1
+        self.evicted.append((self.generation, entry['name']))
+        # Clients that are still attached keep their mapping after unlink,
+        # the memory is released once the last one detaches
+        entry['shm'].close()
+        entry['shm'].unlink()
+
+    def stats(self):
+        with self.lock:
+            return dict(used_bytes=self.used_bytes
+                        , generation=self.generation
+                        , memory_budget=self.memory_budget
+                        , series={k: dict(rows=v['rows'], nbytes=v['nbytes'], hits=v['hits'])
+                                  for k, v in self.loaded.items()}
+                        )
+
+    def shutdown(self):
+        with self.lock:
+            for key in list(self.loaded):
+                self.evict(key)
+
+
+class VaultManager(BaseManager):
+    pass
+
+
+class VaultClientManager(BaseManager):
+    pass
+
+
+def serve_vault(address=VAULT_ADDRESS
+                , authkey=VAULT_AUTHKEY
+                , vault_folders=VAULT_FOLDERS
+                , memory_budget=MEMORY_BUDGET
+                ):
+    store = VaultStore(vault_folders, memory_budget)
+    VaultManager.register('vault', callable=lambda: store)
+    manager = VaultManager(address=address, authkey=authkey)
+    server = manager.get_server()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f'serve_vault() listening on {address[0]}:{address[1]}, '
+          f'budget {memory_budget / 1024**3:.1f} GB')
+    try:
+        server.serve_forever()
+    finally:
+        store.shutdown()
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// CLIENT /////////////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+class VaultClient:
+
+    def __init__(self, address=VAULT_ADDRESS, authkey=VAULT_AUTHKEY):
+        VaultClientManager.register('vault')
+        self.manager = VaultClientManager(address=address, authkey=authkey)
+        self.manager.connect()
+        self.vault = self.manager.vault()
+        self.attached = {}
+        self.generation = 0     # server eviction generation last seen
+        self.stale = []         # evicted blocks still referenced by a returned frame
+
+    def list_series(self, broker=None):
+        return self.vault.list_series(broker)
+
+    def get_series(self, broker, symbol, granularity):
+        # Read-only DataFrame indexed by naive UTC time, backed directly by the
+        # server's shared memory block (no copy is made in the client)
+        # The server may evict the block between acquire and attach, the
+        # second acquire reloads it
+        for attempt in range(3):
+            desc = self.vault.acquire(broker, symbol, granularity, self.generation)
+            self.detach_evicted(desc['evicted'], keep=desc['name'])
+            self.generation = desc['generation']
+            shm = self.attached.get(desc['name'])
+            if shm is not None:
+                break
+            try:
+                shm = SharedMemory(name=desc['name'], track=False)
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+                continue
+            self.attached[desc['name']] = shm
+            break
+
+        times, values = block_views(shm.buf, desc['rows'], len(desc['fields']))
+        times.flags.writeable = False
+        values.flags.writeable = False
+        index = pd.DatetimeIndex(times.view('datetime64[ns]'), name='time', copy=False)
+        return pd.DataFrame(values.T, index=index, columns=desc['fields'], copy=False)
+
+    def get_range(self, broker, symbol, granularity, date_start=None, date_end=None):
+        df = self.get_series(broker, symbol, granularity)
+        start = 0 if date_start is None else df.index.searchsorted(naive_utc(date_start), 'left')
+        end = len(df) if date_end is None else df.index.searchsorted(naive_utc(date_end), 'right')
+        return df.iloc[start:end]
+
+    def detach_evicted(self, evicted, keep=None):
+        # Unmaps blocks the server evicted so the budget bounds RAM in the
+        # clients too. evicted None means all blocks but keep.
+        names = [n for n in self.attached if n != keep] if evicted is None else evicted
+        for name in names:
+            shm = self.attached.pop(name, None)
+            if shm is not None:
+                self.stale.append(shm)
+        still_used = []
+        for shm in self.stale:
+            try:
+                shm.close()
+            except BufferError:
+                still_used.append(shm)  # a returned frame is still alive, retried on the next call
+        self.stale = still_used
+
+    def stats(self):
+        return self.vault.stats()
+
+    def close(self):
+        # Blocks behind frames that are still alive stay mapped, the OS frees
+        # them at exit
+        self.detach_evicted(None)
+
+
+if __name__ == '__main__':
+    serve_vault()
@@ -1,6 +1,238 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from pathlib import Path
+from Shared.index import coverage, load_index, is_stale, format_ms
+
+# Module level imports stay on the standard library. Commands that download,
+# plan or rebuild indexes import pandas and the broker APIs when they run.
+
+ROOT = Path(__file__).parent
+
+VAULTS = {  'FxOpen' : ROOT / 'Broker_FxOpen' / 'hist_quotes'
+          , 'Oanda'  : ROOT / 'Broker_Oanda' / 'hist_quotes'
+          }
+
+CATALOGS = {  'FxOpen' : VAULTS['FxOpen'] / 'refs' / 'tradables_dict.json'
+            }
+
+HEAVY_MODULES = ['pandas', 'numpy', 'requests', 'tenacity', 'dotenv', 'dateutil']
+
+STARTUP_COMMANDS = [  ['status']
+                    , ['coverage']
+                    , ['instruments', 'FxOpen']
+                    ]
+
+
+def print_table(rows, columns):
+    if len(rows) == 0:
+        print('(none)')
+        return
+    cells = [[str(row[c]) if row[c] is not None else '-' for c in columns] for row in rows]
+    widths = [max(len(c), *(len(r[i]) for r in cells)) for i, c in enumerate(columns)]
+    print('  '.join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in cells:
+        print('  '.join(v.ljust(w) for v, w in zip(r, widths)))
+
+
+def brokers(args):
+    return [args.broker] if getattr(args, 'broker', None) else list(VAULTS)
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// METADATA COMMANDS //////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def cmd_status(args):
+    rows = []
+    for broker in brokers(args):
+        local_folder = VAULTS[broker]
+        index = load_index(local_folder)
+        files = list(local_folder.glob('*.pkl'))
+        stale = sum(1 for f in files if f.stem not in index or is_stale(index[f.stem], f))
+        quarantined = len(list((local_folder / 'quarantine').glob('*.pkl')))
+        rows.append(dict(broker=broker
+                         , series=len(files)
+                         , indexed=len(index)
+                         , stale=stale
+                         , quarantined=quarantined
+                         , mb=f'{sum(f.stat().st_size for f in files) / 1024**2:.1f}'
+                         ))
+    print_table(rows, ['broker', 'series', 'indexed', 'stale', 'quarantined', 'mb'])
+
+
+def cmd_coverage(args):
+    rows = []
+    for broker in brokers(args):
+        for row in coverage(VAULTS[broker], args.symbol, args.granularity):
+            row['broker'] = broker
+            row['time_from'] = format_ms(row['time_from'])
+            row['time_to'] = format_ms(row['time_to'])
+            rows.append(row)
+    print_table(rows, ['broker', 'symbol', 'granularity', 'rows', 'time_from', 'time_to', 'status'])
+
+
+def cmd_instruments(args):
+    catalog_file = CATALOGS.get(args.broker)
+    if catalog_file is None or not os.path.exists(catalog_file):
+        print(f'instruments: no local catalog for {args.broker}, run list_broker_inst.py first')
+        return 1
+    with open(catalog_file, 'r') as f:
+        catalog = json.load(f)
+    rows = [dict(symbol=symbol, **inst) for symbol, inst in sorted(catalog.items())
+            if args.group is None or inst.get('StatusGroupId') in args.group]
+    columns = ['symbol', *(rows[0].keys() - {'symbol'})] if rows else ['symbol']
+    print_table(rows, sorted(columns, key=lambda c: c != 'symbol'))
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// HEAVY COMMANDS /////////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def cmd_index(args):
+    from Shared.index import refresh_index
+    for broker in brokers(args):
+        refresh_index(VAULTS[broker], args.rebuild)
+
+
+def cmd_update(args):
+    # Both broker folders define api/get_quotes, so one broker per process
+    sys.path.insert(0, str(ROOT / f'Broker_{args.broker}'))
+    from get_quotes import get_hist_quotes
+    if args.broker == 'FxOpen':
+        from api import FxApi as Api
+    else:
+        from api import OandaApi as Api
+    get_hist_quotes(args.symbols, args.granularities, args.start, args.end, Api(), args.price, args.workers
+                    , args.replace_sides)
+
+
+def cmd_verify(args):
+    sys.path.insert(0, str(ROOT / f'Broker_{args.broker}'))
+    from Shared.adapters import ADAPTERS
+    from Shared.revisions import verify_vault
+    if args.broker == 'FxOpen':
+        from api import FxApi as Api
+    else:
+        from api import OandaApi as Api
+    verify_vault(ADAPTERS[args.broker](Api()), args.symbols, args.granularities, args.chunks, args.selection
+                 , patch=not args.dry_run)
+
+
+def cmd_plan(args):
+    from Shared.planner import compare_plans
+    jobs = [dict(broker=args.broker
+                 , symbol_lst=args.symbols
+                 , granularity_lst=args.granularities
+                 , date_start=args.start
+                 , date_end=args.end
+                 , price=args.price
+                 )]
+    compare_plans(jobs, args.workers, args.accounts)
+
+
+# /////////////////////////////////////////////////////////////////////////
+# /// STARTUP BENCHMARK //////////////////////////////////////////////////
+# ///////////////////////////////////////////////////////////////////////
+
+def imported_modules(command):
+    result = subprocess.run([sys.executable, '-X', 'importtime', __file__, *command]
+                            , capture_output=True, text=True, cwd=ROOT)
+    names = set()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            names.add(line.rsplit('|', 1)[-1].strip().split('.')[0])
+    return names
+
+
+def wall_ms(argv, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(argv, capture_output=True, cwd=ROOT)
+        timings.append((time.perf_counter() - start) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def cmd_bench_startup(args):
+    # Fails when a metadata command pulls in a heavy dependency
+    rows = [dict(command='python -c pass', median_ms=f'{wall_ms([sys.executable, "-c", "pass"], args.runs):.0f}', heavy='-')
+            , dict(command='import pandas', median_ms=f'{wall_ms([sys.executable, "-c", "import pandas"], args.runs):.0f}', heavy='-')]
+    failed = False
+    for command in STARTUP_COMMANDS:
+        heavy = sorted(imported_modules(command) & set(HEAVY_MODULES))
+        failed = failed or len(heavy) > 0
+        rows.append(dict(command=f'main.py {" ".join(command)}'
+                         , median_ms=f'{wall_ms([sys.executable, __file__, *command], args.runs):.0f}'
+                         , heavy=','.join(heavy) or '-'
+                         ))
+    print_table(rows, ['command', 'median_ms', 'heavy'])
+    if failed:
+        print('bench-startup: FAILED, metadata commands imported heavy modules')
+        return 1
+
+
 def main():
-    print("Hello from price-tape!")
+    arg_parser = argparse.ArgumentParser(description='price-tape command line')
+    commands = arg_parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('status', help='series, index and quarantine counts per vault')
+    p.add_argument('--broker', choices=list(VAULTS))
+    p.set_defaults(run=cmd_status)
+
+    p = commands.add_parser('coverage', help='stored time range per series, from the vault index')
+    p.add_argument('--broker', choices=list(VAULTS))
+    p.add_argument('--symbol')
+    p.add_argument('--granularity')
+    p.set_defaults(run=cmd_coverage)
+
+    p = commands.add_parser('instruments', help='instruments in the local catalog')
+    p.add_argument('broker', choices=list(CATALOGS))
+    p.add_argument('--group', nargs='+', help='StatusGroupId filter, e.g. Forex Crypto')
+    p.set_defaults(run=cmd_instruments)
+
+    p = commands.add_parser('index', help='index new or changed series (reads them)')
+    p.add_argument('--broker', choices=list(VAULTS))
+    p.add_argument('--rebuild', action='store_true')
+    p.set_defaults(run=cmd_index)
+
+    for name, run, help in [('update', cmd_update, 'download and store candles')
+                            , ('plan', cmd_plan, 'dry run a download, no network')]:
+        p = commands.add_parser(name, help=help)
+        p.add_argument('broker', choices=list(VAULTS))
+        p.add_argument('--symbols', nargs='+', required=True)
+        p.add_argument('--granularities', nargs='+', required=True)
+        p.add_argument('--start', required=True)
+        p.add_argument('--end', required=True)
+        p.add_argument('--price', default='BA')
+        if name == 'update':
+            p.add_argument('--workers', type=int, default=None)
+            p.add_argument('--replace-sides', action='store_true'
+                           , help='let a --price with fewer sides replace a stored series')
+        else:
+            p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+            p.add_argument('--accounts', type=int, nargs='+', default=[1])
+        p.set_defaults(run=run)
+
+    p = commands.add_parser('verify', help='re-fetch a few chunks per series and patch restated history')
+    p.add_argument('broker', choices=list(VAULTS))
+    p.add_argument('--symbols', nargs='+', default=None)
+    p.add_argument('--granularities', nargs='+', default=None)
+    p.add_argument('--chunks', type=int, default=4, help='chunks re-fetched per series')
+    p.add_argument('--selection', choices=['oldest', 'random', 'recent'], default='oldest')
+    p.add_argument('--dry-run', action='store_true', help='log revisions without patching')
+    p.set_defaults(run=cmd_verify)
+
+    p = commands.add_parser('bench-startup', help='time metadata commands and check they stay light')
+    p.add_argument('--runs', type=int, default=5)
+    p.set_defaults(run=cmd_bench_startup)
+
+    args = arg_parser.parse_args()
+    return args.run(args)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,45 @@
+import sys
+import json
+import subprocess
+import pytest
+from main import ROOT, STARTUP_COMMANDS, wall_ms
+
+# Metadata commands must answer without loading the download stack. Each
+# command runs in a fresh interpreter, which reports the modules it ended
+# up with and how long the whole run took.
+
+FORBIDDEN_MODULES = ['pandas', 'requests', 'tenacity']
+STARTUP_MARGIN_MS = 200     # allowed over a bare interpreter, importing pandas alone costs more
+RUNS = 5
+
+MODULES_SCRIPT = '''
+import sys, json, runpy
+sys.argv = ['main.py', *json.loads(sys.argv[1])]
+try:
+    runpy.run_path('main.py', run_name='__main__')
+except SystemExit:
+    pass
+print('MODULES ' + json.dumps(sorted(sys.modules)))
+'''
+
+
+def loaded_modules(command):
+    result = subprocess.run([sys.executable, '-c', MODULES_SCRIPT, json.dumps(command)]
+                            , capture_output=True, text=True, cwd=ROOT)
+    assert result.returncode == 0, result.stderr
+    line = [l for l in result.stdout.splitlines() if l.startswith('MODULES ')][-1]
+    return {name.split('.')[0] for name in json.loads(line[len('MODULES '):])}
+
+
+@pytest.mark.parametrize('command', STARTUP_COMMANDS, ids=' '.join)
+def test_metadata_command_stays_light(command):
+    heavy = loaded_modules(command) & set(FORBIDDEN_MODULES)
+    assert not heavy, f'main.py {" ".join(command)} imported {sorted(heavy)}'
+
+
+@pytest.mark.parametrize('command', STARTUP_COMMANDS, ids=' '.join)
+def test_metadata_command_startup_time(command):
+    baseline = wall_ms([sys.executable, '-c', 'pass'], RUNS)
+    elapsed = wall_ms([sys.executable, str(ROOT / 'main.py'), *command], RUNS)
+    assert elapsed < baseline + STARTUP_MARGIN_MS, \
+        f'main.py {" ".join(command)} took {elapsed:.0f} ms, python alone {baseline:.0f} ms'
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from Shared.synthetic import generate_vault
+from Shared.engine import load_from_file
+from Shared.validation import sweep_vault
+from Shared.index import coverage
+from Shared.query import VaultSQL
+from Shared.timeutils import epoch_ms
+
+# A small synthetic vault per broker, read back through the same paths real
+# series go through, so the generator and the readers cannot drift apart.
+
+GRANULARITIES = ['M5', 'H1']
+SYMBOLS = 6         # two of each default group
+DATE_START = '2024-01-01'
+DATE_END = '2024-01-22'
+
+
+@pytest.fixture(scope='module', params=['FxOpen', 'Oanda'])
+def vault(request, tmp_path_factory):
+    broker = request.param
+    local_folder = tmp_path_factory.mktemp(f'synthetic_{broker}')
+    entries = generate_vault(broker, local_folder, SYMBOLS, GRANULARITIES, DATE_START, DATE_END, workers=2)
+    return broker, local_folder, entries
+
+
+def test_every_series_written(vault):
+    _, local_folder, entries = vault
+    assert len(entries) == SYMBOLS * len(GRANULARITIES)
+    assert sorted(f.stem for f in local_folder.glob('*.pkl')) == sorted(entries)
+
+
+def test_load_from_file(vault):
+    _, local_folder, entries = vault
+    for series_name, entry in entries.items():
+        symbol, granularity = series_name.rsplit('_', 1)
+        df = load_from_file(symbol, granularity, local_folder)
+        assert len(df) == entry['rows'] > 0
+        assert df['time'].dtype == 'datetime64[ms]'
+        assert df['time'].is_monotonic_increasing and df['time'].is_unique
+        assert df.attrs['price_components'] == entry['price_components'] == 'BA'
+        assert (df['ask_c'] >= df['bid_c']).all()
+        t = epoch_ms(df['time'])
+        assert (int(t.min()), int(t.max())) == (entry['time_from'], entry['time_to'])
+
+
+def test_sweep_vault_passes(vault):
+    _, local_folder, entries = vault
+    results = sweep_vault(local_folder, workers=2, quarantine=False, print_to_console=False)
+    assert results == {f'{name}.pkl': True for name in entries}
+
+
+def test_coverage_matches_generated_spans(vault):
+    _, local_folder, entries = vault
+    rows = coverage(local_folder)
+    assert len(rows) == len(entries)
+    for row in rows:
+        entry = entries[f"{row['symbol']}_{row['granularity']}"]
+        assert row['status'] == 'ok'
+        assert (row['rows'], row['time_from'], row['time_to']) == (entry['rows'], entry['time_from'], entry['time_to'])
+        assert np.datetime64(DATE_START) <= np.datetime64(row['time_from'], 'ms') < np.datetime64(DATE_END)
+        assert np.datetime64(DATE_START) <= np.datetime64(row['time_to'], 'ms') < np.datetime64(DATE_END)
+
+
+def test_sql_row_counts(vault):
+    broker, local_folder, entries = vault
+    vault_sql = VaultSQL({broker: local_folder})
+    vault_sql.sync(None, 2)
+    for granularity in GRANULARITIES:
+        counts = vault_sql.query('SELECT symbol, count(*) AS bars, min(time) AS time_from, max(time) AS time_to '
+                                 'FROM quotes GROUP BY symbol', granularities=[granularity], cache=False)
+        expected = {name.rsplit('_', 1)[0]: entry for name, entry in entries.items()
+                    if name.endswith(f'_{granularity}')}
+        assert sorted(counts['symbol']) == sorted(expected)
+        for row in counts.itertuples():
+            entry = expected[row.symbol]
+            assert (row.bars, row.time_from, row.time_to) == (entry['rows'], entry['time_from'], entry['time_to'])